@@ -9,15 +9,29 @@ import zipfile
 import requests
 import warnings
 import gc
+import queue
+import threading
+import multiprocessing
 import unicodedata
+import hashlib
+import shutil
+import tempfile
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 from bs4 import BeautifulSoup as soup
 from urllib.parse import urljoin
 from datetime import datetime
-from collections import Counter
-
-from sqlalchemy import create_engine, text, inspect
+from collections import Counter, defaultdict, deque
+from contextlib import contextmanager
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from psycopg2 import errors as pg_errors
+from psycopg2.extras import execute_values
+from sqlalchemy import create_engine, event, text, inspect
 from sqlalchemy.types import Integer, String, Date, DateTime, Numeric, Float
 
 # Configuração de Logging
@@ -36,12 +50,23 @@ DB_CONFIG = {
 }
 DATABASE_URL = f"postgresql+psycopg2://{DB_CONFIG['user']}:{DB_CONFIG['password']}@{DB_CONFIG['host']}:{DB_CONFIG['port']}/{DB_CONFIG['dbname']}"
 
+# Pool do SQLAlchemy: cada carga paralela usa uma conexão por lote (UnitOfWork),
+# mais as conexões curtas de DDL, checkpoints, views e espelho.
+DB_POOL = {
+    "pool_size": 6,
+    "max_overflow": 4,
+    "pool_timeout": 60,
+    "pool_recycle": 1800
+}
+
 # ==============================================================================
 # CONFIGURAÇÕES DE SCHEMA (LEITOS, BPS, BNAFAR)
 # ==============================================================================
 
 config_leitos = {
     "name": "ETL_Leitos_Sus",
+    "load_method": "copy",
+    "max_parallel_files": 2,
     "source": {"path": "DYNAMIC", "format": "csv"},
     "clean_numbers": ["cnes", "co_cep", "co_ibge"],
     "dimensions": [
@@ -93,6 +118,8 @@ config_leitos = {
     ],
     "fact": {
         "target_table": "leitos", "id_col": "leitos_id",
+        # Particionamento por faixa de data (uma partição por ano de competência)
+        "partition": {"column": "data_de_competencia", "interval": "year"},
         "lookups": { 
             "instituicao": {
                 "target_id_col": "instituicao_id", 
@@ -101,7 +128,7 @@ config_leitos = {
             } 
         },
         "mapping": {
-            "comp": ("data_de_competencia", "date"),
+            "comp": ("data_de_competencia", "date", "%Y%m"),
             "leitos_existentes": ("quantidade_leitos_gerais", "int"),
             "leitos_sus": ("quantidade_leitos_sus", "int"),
             "uti_total_exist": ("quantidade_leitos_uti", "int"),
@@ -122,6 +149,8 @@ config_leitos = {
 
 config_bps = {
     "name": "ETL_BPS_Compras",
+    "load_method": "copy",
+    "max_parallel_files": 2,
     "source": {"path": "DYNAMIC", "format": "csv"},
     "clean_numbers": ["cnpj_instituicao", "cnpj_fornecedor", "cnpj_fabricante"],
     "dimensions": [
@@ -167,6 +196,7 @@ config_bps = {
     "fact": {
         "target_table": "instituicao_compra_produto", 
         "id_col": "instituicao_compra_produto_id",
+        "partition": {"column": "data_de_compra", "interval": "year"},
         "lookups": {
             "fornecedor": {
                 "target_id_col": "fornecedor_id", 
@@ -190,8 +220,8 @@ config_bps = {
             }
         },
         "mapping": {
-            "compra": ("data_de_compra", "date"), 
-            "insercao": ("data_de_insercao", "date"),
+            "compra": ("data_de_compra", "date", "%Y-%m-%d"), 
+            "insercao": ("data_de_insercao", "date", "%Y-%m-%d"),
             "modalidade_da_compra": "modalidade_de_compra",
             "capacidade": ("capacidade", "decimal"), 
             "unidade_medida": "unidade_de_medida", 
@@ -206,7 +236,10 @@ config_bps = {
 config_bnafar = {
     "name": "ETL_BNAFAR_Estoque",
     "batch_size": 500000,
-    "source": {"path": "DYNAMIC", "format": "csv"},
+    "load_method": "copy",
+    "max_parallel_files": 1,
+    "pipelined": True,
+    "source": {"path": "DYNAMIC", "format": "csv", "streaming": True},
     "clean_numbers": ["co_cnes", "co_cep"],
     "dimensions": [
         {
@@ -260,6 +293,7 @@ config_bnafar = {
     "fact": {
         "target_table": "instituicao_estoca_produto", 
         "id_col": "instituicao_estoca_produto_id",
+        "partition": {"column": "data_de_posicao_no_estoque", "interval": "year"},
         "lookups": { 
             "instituicao": {
                 "target_id_col": "instituicao_id", 
@@ -273,10 +307,10 @@ config_bnafar = {
             } 
         },
         "mapping": {
-            "dt_posicao_estoque": ("data_de_posicao_no_estoque", "date"),
+            "dt_posicao_estoque": ("data_de_posicao_no_estoque", "date", "%Y-%m-%d"),
             "qt_estoque": ("quantidade_do_item_em_estoque", "decimal"), 
             "nu_lote": "numero_do_lote",
-            "dt_validade": ("data_de_validade", "timestamp"),
+            "dt_validade": ("data_de_validade", "timestamp", "%Y-%m-%d %H:%M:%S"),
             "tp_produto": "tipo_do_produto", 
             "sg_programa_saude": "sigla_do_programa_de_saude", 
             "ds_programa_saude": "descricao_do_programa_de_saude", 
@@ -297,31 +331,326 @@ CONFIG_MAP = {
     "bnafar": config_bnafar
 }
 
+# ==============================================================================
+# VIEWS DE CONSULTA (SCHEMA DESNORMALIZADO DO TEXT-TO-SQL)
+# ==============================================================================
+# As consultas do corpus usam relações desnormalizadas (leitos, bps, bnafar) com
+# nomes de coluna próprios. Elas viram views materializadas no schema abaixo,
+# já com as dimensões juntadas; quem consulta usa search_path = consulta, public.
+QUERY_SCHEMA = "consulta"
+
+# Cada view: fato (tabela, alias), LEFT JOINs (tabela, alias, condição), chave única
+# (para o REFRESH CONCURRENTLY) e colunas. Uma coluna é "alias.coluna" ou
+# ("alias.coluna", expressão com {}[, expressão no DuckDB]); colunas que o star
+# schema ainda não tem saem NULL. As mesmas views existem no espelho DuckDB.
+QUERY_VIEWS = {
+    "leitos": {
+        "fact": ("leitos", "f"),
+        "joins": [
+            ("instituicao", "i", "i.instituicao_id = f.instituicao_id"),
+            ("endereco", "e", "e.endereco_id = i.endereco_id")
+        ],
+        "key": "leitos_id",
+        "columns": {
+            "leitos_id": "f.leitos_id",
+            "data_competencia": "f.data_de_competencia",
+            "data_competencia_info": ("f.data_de_competencia", "to_char({}, 'YYYYMM')", "strftime({}, '%Y%m')"),
+            "cnes": "i.codigo_cnes",
+            "nome_hospital": "i.nome_instituicao",
+            "nome_estabelecimento": "i.nome_instituicao",
+            "razao_social": "i.razao_social",
+            "tipo_gestao_do_hospital": "i.tipo_de_gestao",
+            "descricao_tipo_unidade": "i.descricao_do_tipo_da_unidade",
+            "natureza_juridica": "i.descricao_da_natureza_juridica",
+            "municipio_hospital": "e.municipio",
+            "uf_hospital": "e.unidade_federativa",
+            "regiao": "e.regiao_do_brasil",
+            "codigo_ibge": "e.codigo_do_ibge",
+            "leitos_geral": "f.quantidade_leitos_gerais",
+            "leitos_sus": "f.quantidade_leitos_sus",
+            "uti_total": "f.quantidade_leitos_uti",
+            "uti_sus": "f.quantidade_leitos_uti_sus",
+            "uti_adulto": "f.quantidade_leitos_uti_adulto",
+            "uti_sus_adulto": "f.quantidade_leitos_uti_sus_adulto",
+            "uti_pediatrico": "f.quantidade_leitos_uti_pediatrico",
+            "uti_sus_pediatrico": "f.quantidade_leitos_uti_sus_pediatrico",
+            "uti_neonatal": "f.quantidade_leitos_uti_neonatal",
+            "uti_sus_neonatal": "f.quantidade_leitos_uti_sus_neonatal",
+            "uti_queimado": "f.quantidade_leitos_uti_queimado",
+            "uti_sus_queimado": "f.quantidade_leitos_uti_sus_queimado",
+            "uti_coronariana": "f.quantidade_leitos_uti_coronariana",
+            "uti_sus_coronariana": "f.quantidade_leitos_uti_sus_coronariana"
+        }
+    },
+    "bps": {
+        "fact": ("instituicao_compra_produto", "f"),
+        "joins": [
+            ("produto", "p", "p.produto_id = f.produto_id"),
+            ("fornecedor", "fo", "fo.fornecedor_id = f.fornecedor_id"),
+            ("fabricante", "fa", "fa.fabricante_id = f.fabricante_id"),
+            ("instituicao", "i", "i.instituicao_id = f.instituicao_id"),
+            ("endereco", "e", "e.endereco_id = i.endereco_id")
+        ],
+        "key": "compra_id",
+        "columns": {
+            "compra_id": "f.instituicao_compra_produto_id",
+            "data_compra": "f.data_de_compra",
+            "ano_compra": ("f.data_de_compra", "EXTRACT(YEAR FROM {})::int"),
+            "data_insercao": "f.data_de_insercao",
+            "modalidade_compra": "f.modalidade_de_compra",
+            "tipo_compra": "f.tipo_da_compra",
+            "unidade_medida": "f.unidade_de_medida",
+            "capacidade": "f.capacidade",
+            "quantidade_itens_comprados": "f.quantidade_de_itens",
+            "preco_unitario": "f.preco_unitario",
+            "preco_total": "f.preco_total",
+            "codigo_br": "p.codigo_catmat",
+            "descricao_catmat": "p.descricao_catmat",
+            "anvisa": "p.anvisa",
+            "generico": "p.generico",
+            "cnpj_fornecedor": "fo.cnpj_fornecedor",
+            "fornecedor": "fo.nome_fornecedor",
+            "cnpj_fabricante": "fa.cnpj_fabricante",
+            "fabricante": "fa.nome_fabricante",
+            "cnpj_instituicao": "i.cnpj_instituicao",
+            "nome_instituicao": "i.nome_instituicao",
+            "municipio": "e.municipio",
+            "uf_instituicao": "e.unidade_federativa"
+        }
+    },
+    "bnafar": {
+        "fact": ("instituicao_estoca_produto", "f"),
+        "joins": [
+            ("produto", "p", "p.produto_id = f.produto_id"),
+            ("instituicao", "i", "i.instituicao_id = f.instituicao_id"),
+            ("endereco", "e", "e.endereco_id = i.endereco_id")
+        ],
+        "key": "estoque_id",
+        "columns": {
+            "estoque_id": "f.instituicao_estoca_produto_id",
+            "data_posicao_estoque": "f.data_de_posicao_no_estoque",
+            "quantidade_estoque": "f.quantidade_do_item_em_estoque",
+            "numero_lote": "f.numero_do_lote",
+            "data_validade": "f.data_de_validade",
+            "tipo_produto": "f.tipo_do_produto",
+            "sigla_programa_saude": "f.sigla_do_programa_de_saude",
+            "nome_programa": "f.descricao_do_programa_de_saude",
+            "sigla_origem": "f.sigla_do_sistema_de_origem",
+            "co_catmat": "p.codigo_catmat",
+            "descricao_produto": "p.descricao_catmat",
+            "codigo_cnes": "i.codigo_cnes",
+            "co_cnes": "i.codigo_cnes",
+            "nome_fantasia": "i.nome_instituicao",
+            "razao_social": "i.razao_social",
+            "municipio": "e.municipio",
+            "uf": "e.unidade_federativa",
+            "codigo_ibge": "e.codigo_do_ibge"
+        }
+    }
+}
+
+# Tracker das versões anteriores: uma URL processada por linha, sem validadores
+LEGACY_TRACKING_FILE = "processed_files_pg.txt"
+
 class ProcessTracker:
-    """Gerencia quais URLs já foram processadas."""
-    def __init__(self, tracking_file="processed_files_pg.txt"):
+    """Gerencia quais recursos já foram processados e em qual versão.
+
+    Para cada URL guarda os validadores HTTP (ETag, Last-Modified,
+    Content-Length) e o sha256 do conteúdo baixado; com eles o download é
+    condicional e arquivos sem alteração são pulados.
+    """
+    def __init__(self, tracking_file="processed_files_pg.json", legacy_file=LEGACY_TRACKING_FILE):
         self.tracking_file = tracking_file
+        self.legacy_file = legacy_file
         self.processed = self._load_processed()
+        self._lock = threading.Lock()
 
     def _load_processed(self):
         if not os.path.exists(self.tracking_file):
-            return set()
+            return self._load_legacy()
         with open(self.tracking_file, "r") as f:
-            return set(line.strip() for line in f)
+            return json.load(f)
+
+    def _load_legacy(self):
+        """Importa o tracker .txt antigo. As URLs entram sem validadores, então
+        continuam sendo baixadas; as linhas que elas carregaram não têm
+        arquivo_origem_id e são tratadas em main (untagged_fact_tables)."""
+        if not self.legacy_file or not os.path.exists(self.legacy_file):
+            return {}
+        with open(self.legacy_file, "r") as f:
+            urls = [line.strip() for line in f if line.strip()]
+        logging.info(f"📜 Tracker legado {self.legacy_file}: {len(urls)} URLs importadas")
+        return {url: {"legado": True} for url in urls}
 
     def is_processed(self, url):
         return url in self.processed
 
-    def mark_processed(self, url):
-        with open(self.tracking_file, "a") as f:
-            f.write(f"{url}\n")
-        self.processed.add(url)
-
+    def get(self, url):
+        return self.processed.get(url)
+
+    def conditional_headers(self, url):
+        meta = self.processed.get(url) or {}
+        headers = {}
+        if meta.get("etag"): headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"): headers["If-Modified-Since"] = meta["last_modified"]
+        return headers
+
+    def is_unchanged(self, url, meta):
+        """True se o servidor respondeu 304 ou se o conteúdo tem o mesmo hash já carregado."""
+        prev = self.processed.get(url)
+        if not prev or not meta: return False
+        if meta.get("not_modified"): return True
+        return bool(meta.get("sha256")) and meta["sha256"] == prev.get("sha256")
+
+    def mark_processed(self, url, meta=None):
+        with self._lock:
+            entry = dict(self.processed.get(url) or {})
+            entry.update({k: v for k, v in (meta or {}).items() if v is not None and k != "not_modified"})
+            entry.pop("recarregar", None)
+            entry["processed_at"] = datetime.now().isoformat(timespec="seconds")
+            self.processed[url] = entry
+            self._save()
+
+    def mark_reload(self, url):
+        """Marca um recurso já carregado para recarga completa, mesmo que o
+        arquivo não mude; a marca sai no próximo mark_processed."""
+        with self._lock:
+            entry = self.processed.get(url)
+            if entry is None or entry.get("recarregar"): return
+            self.processed[url] = {**entry, "recarregar": True}
+            self._save()
+
+    def needs_reload(self, url):
+        return bool((self.processed.get(url) or {}).get("recarregar"))
+
+    def _save(self):
+        tmp = self.tracking_file + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.processed, f, indent=1)
+        os.replace(tmp, self.tracking_file)
+
+class DataVersion:
+    """Contador de versão dos dados, incrementado pelo ETL a cada carga concluída.
+
+    Fica em um arquivo JSON (como o ProcessTracker) para que outros processos,
+    como o cache de resultados da API, saibam quando o que leram ficou velho.
+    current() só relê o arquivo quando o mtime muda.
+    """
+    def __init__(self, path="versao_dados.json"):
+        self.path = path
+        self._lock = threading.RLock()
+        self._mtime = None
+        self._version = 0
+
+    def current(self):
+        with self._lock:
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+            except FileNotFoundError:
+                return 0
+            if mtime != self._mtime:
+                try:
+                    with open(self.path, "r") as f:
+                        self._version = int(json.load(f)["versao"])
+                except (ValueError, KeyError, json.JSONDecodeError):
+                    return self._version
+                self._mtime = mtime
+            return self._version
+
+    def bump(self):
+        """Incrementa a versão (gravação atômica) e devolve o novo valor."""
+        with self._lock:
+            version = self.current() + 1
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump({"versao": version, "atualizado_em": datetime.now().isoformat(timespec="seconds")}, f)
+            os.replace(tmp, self.path)
+        return version
+
+def source_key(url):
+    """Id estável (BIGINT) de um recurso, gravado nas fatos como arquivo_origem_id."""
+    return int.from_bytes(hashlib.blake2b(url.encode("utf-8"), digest_size=8).digest(), "big") >> 1
+
+
+# Cubos de agregação (tabelas no schema de consulta) mantidos lote a lote, na
+# mesma transação do COPY da fato: cada lote soma sua contribuição e a remoção
+# de um recurso (delete_source) a subtrai. Grão: expressões (com COALESCE, pois
+# formam a PK) sobre a fato "f" e os joins; medidas: ("sum" | "count", expressão).
+# Toda tabela ganha "linhas" (COUNT(*)); médias saem de soma / contagem.
+ROLLUPS = {
+    "leitos_uf_municipio_competencia": {
+        "fact": "leitos",
+        "joins": [
+            ("instituicao", "i", "i.instituicao_id = f.instituicao_id"),
+            ("endereco", "e", "e.endereco_id = i.endereco_id")
+        ],
+        "grain": {
+            "uf_hospital": ("COALESCE(e.unidade_federativa, '')", "TEXT"),
+            "municipio_hospital": ("COALESCE(e.municipio, '')", "TEXT"),
+            "data_competencia_info": ("COALESCE(to_char(f.data_de_competencia, 'YYYYMM'), '')", "TEXT")
+        },
+        "measures": {
+            "leitos_geral": ("sum", "f.quantidade_leitos_gerais"),
+            "leitos_sus": ("sum", "f.quantidade_leitos_sus"),
+            "uti_total": ("sum", "f.quantidade_leitos_uti"),
+            "uti_sus": ("sum", "f.quantidade_leitos_uti_sus"),
+            "uti_adulto": ("sum", "f.quantidade_leitos_uti_adulto"),
+            "uti_sus_adulto": ("sum", "f.quantidade_leitos_uti_sus_adulto"),
+            "uti_pediatrico": ("sum", "f.quantidade_leitos_uti_pediatrico"),
+            "uti_sus_pediatrico": ("sum", "f.quantidade_leitos_uti_sus_pediatrico"),
+            "uti_neonatal": ("sum", "f.quantidade_leitos_uti_neonatal"),
+            "uti_sus_neonatal": ("sum", "f.quantidade_leitos_uti_sus_neonatal")
+        }
+    },
+    "bps_produto_ano_uf": {
+        "fact": "instituicao_compra_produto",
+        "joins": [
+            ("produto", "p", "p.produto_id = f.produto_id"),
+            ("instituicao", "i", "i.instituicao_id = f.instituicao_id"),
+            ("endereco", "e", "e.endereco_id = i.endereco_id")
+        ],
+        "grain": {
+            "produto_id": ("COALESCE(f.produto_id, 0)", "INTEGER"),
+            "codigo_br": ("COALESCE(p.codigo_catmat, '')", "TEXT"),
+            "descricao_catmat": ("COALESCE(p.descricao_catmat, '')", "TEXT"),
+            "ano_compra": ("COALESCE(EXTRACT(YEAR FROM f.data_de_compra)::int, 0)", "INTEGER"),
+            "uf_instituicao": ("COALESCE(e.unidade_federativa, '')", "TEXT")
+        },
+        "measures": {
+            "quantidade_itens_comprados": ("sum", "f.quantidade_de_itens"),
+            "preco_total": ("sum", "f.preco_total"),
+            "preco_unitario_soma": ("sum", "f.preco_unitario"),
+            "preco_unitario_n": ("count", "f.preco_unitario")
+        }
+    },
+    "bps_fornecedor_ano_uf": {
+        "fact": "instituicao_compra_produto",
+        "joins": [
+            ("fornecedor", "fo", "fo.fornecedor_id = f.fornecedor_id"),
+            ("instituicao", "i", "i.instituicao_id = f.instituicao_id"),
+            ("endereco", "e", "e.endereco_id = i.endereco_id")
+        ],
+        "grain": {
+            "fornecedor_id": ("COALESCE(f.fornecedor_id, 0)", "INTEGER"),
+            "cnpj_fornecedor": ("COALESCE(fo.cnpj_fornecedor, '')", "TEXT"),
+            "fornecedor": ("COALESCE(fo.nome_fornecedor, '')", "TEXT"),
+            "ano_compra": ("COALESCE(EXTRACT(YEAR FROM f.data_de_compra)::int, 0)", "INTEGER"),
+            "uf_instituicao": ("COALESCE(e.unidade_federativa, '')", "TEXT")
+        },
+        "measures": {
+            "quantidade_itens_comprados": ("sum", "f.quantidade_de_itens"),
+            "preco_total": ("sum", "f.preco_total")
+        }
+    }
+}
 
 # ==============================================================================
 # CLASSES DE SUPORTE
 # ==============================================================================
 
+# Checkpoints por lote das cargas de fato (ver SGBDLoader.prepare_source)
+CHECKPOINT_TABLE = "etl_checkpoint"
+
 type_map = {
     "date": "DATE",
     "int": "INTEGER",
@@ -330,12 +659,84 @@ type_map = {
     "text": "TEXT"
 }
 
+# Valores que viram nulo após strip/upper
+NULL_SENTINELS = pa.array(['NAN', 'NONE', '', 'N/A'])
+
+# ------------------------------------------------------------------------------
+# Conversores tipados. O mapping aceita (destino, tipo) ou (destino, tipo, formato):
+#   date/timestamp -> formato strftime (ex: "%Y%m"); sem formato, o pandas infere
+#   decimal/latlong -> "br" (milhar '.', decimal ',', padrão) ou "en" (milhar ',', decimal '.')
+# ------------------------------------------------------------------------------
+NUMERIC_PATTERN = r'^-?([0-9]+\.?[0-9]*|\.[0-9]+)$'
+DECIMAL_SEPARATORS = {"br": (".", ","), "en": (",", ".")}
+
+def _to_arrow_strings(series: pd.Series) -> pa.Array:
+    try:
+        return pa.array(series.to_numpy(dtype=object), type=pa.string(), from_pandas=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return pa.array(series.where(series.isna(), series.astype(str)).to_numpy(dtype=object), type=pa.string(), from_pandas=True)
+
+@lru_cache(maxsize=None)
+def get_parser(type_, fmt=None):
+    """Devolve (e guarda) o conversor Series -> Series para um tipo/formato do mapping."""
+    if type_ in ["date", "timestamp"]:
+        def infer(col_series):
+            dt_series = pd.to_datetime(col_series, errors='coerce', utc=True)
+            return dt_series.dt.date if type_ == "date" else dt_series
+
+        if fmt is None:
+            return infer
+
+        def parse_datetime(col_series):
+            if type_ == "date":
+                # strptime do Arrow direto para date32 (evita o .dt.date linha a linha)
+                ts = pc.strptime(_to_arrow_strings(col_series), format=fmt, unit='s', error_is_null=True)
+                out = pd.Series(pc.cast(ts, pa.date32()).to_pandas(), index=col_series.index, dtype=object)
+            else:
+                out = pd.to_datetime(col_series, format=fmt, errors='coerce', utc=True)
+            # Valores fora do formato declarado ainda passam pela inferência
+            retry = out.isna() & col_series.notna()
+            if retry.any():
+                out[retry] = infer(col_series[retry])
+            return out
+        return parse_datetime
+
+    if type_ == "int":
+        return lambda col_series: pd.to_numeric(col_series, errors='coerce').fillna(0).astype(int)
+
+    if type_ in ["decimal", "latlong"]:
+        thousands, decimal = DECIMAL_SEPARATORS[fmt or "br"]
+        def parse_decimal(col_series):
+            # Tudo em kernels Arrow: remove milhar, normaliza decimal, descarta lixo
+            arr = _to_arrow_strings(col_series)
+            arr = pc.replace_substring(arr, thousands, "")
+            if decimal != ".":
+                arr = pc.replace_substring(arr, decimal, ".")
+            arr = pc.replace_substring_regex(arr, r'[^0-9.\-]', "")
+            arr = pc.if_else(pc.match_substring_regex(arr, NUMERIC_PATTERN), arr, pa.scalar(None, pa.string()))
+            values = pc.cast(arr, pa.float64()).to_numpy(zero_copy_only=False)
+            return pd.Series(values, index=col_series.index)
+        return parse_decimal
+
+    raise ValueError(f"Tipo desconhecido no mapping: {type_}")
+
 class Sanitizer:
     @staticmethod
-    def clean_generic(df: pd.DataFrame) -> pd.DataFrame:
-        for col in df.columns:
-            df[col] = df[col].astype(str).str.strip().str.upper()
-            df[col] = df[col].replace(['NAN', 'NONE', '', 'N/A'], None)
+    def clean_string_series(series: pd.Series) -> pd.Series:
+        """strip + upper + sentinelas -> nulo em uma passada de kernels Arrow.
+        Nulos reais continuam nulos (sem o desvio NaN -> 'NAN' -> None)."""
+        arr = _to_arrow_strings(series)
+        arr = pc.utf8_upper(pc.utf8_trim_whitespace(arr))
+        arr = pc.if_else(pc.is_in(arr, value_set=NULL_SENTINELS), pa.scalar(None, pa.string()), arr)
+        return pd.Series(arr.to_pandas(), index=series.index, name=series.name)
+
+    @staticmethod
+    def clean_generic(df: pd.DataFrame, columns=None) -> pd.DataFrame:
+        """Limpa as colunas de texto. Com `columns`, só as colunas listadas
+        (as que a config usa) são tocadas; as demais seguem como vieram."""
+        cols = df.columns if columns is None else [c for c in df.columns if c in set(columns)]
+        for col in cols:
+            df[col] = Sanitizer.clean_string_series(df[col])
         return df
 
     @staticmethod
@@ -364,18 +765,8 @@ class Sanitizer:
             
             if isinstance(tgt, tuple):
                 name, type_ = tgt[0].lower(), tgt[1]
-                if type_ in ["date", "timestamp"]:
-                    dt_series = pd.to_datetime(col_series, errors='coerce', utc=True)
-                    if type_ == "date":
-                        df_out[name] = dt_series.dt.date
-                    else:
-                        df_out[name] = dt_series
-                elif type_ == "int":
-                    df_out[name] = pd.to_numeric(col_series, errors='coerce').fillna(0).astype(int)
-                elif type_ in ["decimal", "latlong"]:
-                    s = col_series.astype(str).str.replace('.', '', regex=False).str.replace(',', '.', regex=False)
-                    s = s.str.replace(r'[^0-9.]', '', regex=True)
-                    df_out[name] = pd.to_numeric(s, errors='coerce')
+                fmt = tgt[2] if len(tgt) > 2 else None
+                df_out[name] = get_parser(type_, fmt)(col_series)
             else:
                 # 3. Tratamento crucial para Chaves de Join (Anvisa, etc)
                 # Se não for um tipo especial (tuple), garantimos que nulos virem string vazia
@@ -383,13 +774,488 @@ class Sanitizer:
         
         return df_out
 
+def key_hash(df: pd.DataFrame, keys) -> np.ndarray:
+    """Hash de 64 bits da chave natural de cada linha (colunas em ordem alfabética,
+    para que fato e dimensão cheguem ao mesmo valor mesmo listando as chaves em
+    ordem diferente). Colunas ausentes contam como string vazia."""
+    cols = sorted(k.lower() for k in keys)
+    frame = df.reindex(columns=cols, fill_value="").astype(object)
+    return pd.util.hash_pandas_object(frame, index=False, categorize=False).to_numpy()
+
+class DimensionCache:
+    """Cache, por execução, de hash da chave natural -> id de cada dimensão.
+
+    Carregado do banco uma única vez por (tabela, chaves) e atualizado apenas
+    com os ids das linhas inseridas depois (INSERT ... RETURNING). Os hashes
+    ficam ordenados ao lado dos ids, e as buscas são np.searchsorted sobre
+    inteiros em vez de merges em colunas de texto. Com hashes de 64 bits, uma
+    colisão só se torna provável na casa dos bilhões de chaves por dimensão.
+    """
+    def __init__(self):
+        self._slots = {}
+        # Só protege a troca dos arrays (nunca fica preso durante I/O no banco)
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self._slots.clear()
+
+    def is_loaded(self, table_name, keys):
+        return (table_name, tuple(keys)) in self._slots
+
+    def load(self, table_name, keys, id_col, df_db):
+        slot = self._sorted(key_hash(df_db, keys), df_db[id_col].to_numpy(dtype=np.int64))
+        with self._lock:
+            # Outra carga pode ter carregado (e acrescentado ids) enquanto este lia o banco
+            self._slots.setdefault((table_name, tuple(keys)), slot)
+
+    @staticmethod
+    def _sorted(hashes, ids):
+        order = np.argsort(hashes, kind="stable")
+        return hashes[order], ids[order]
+
+    def _positions(self, table_name, keys, hashes):
+        known, ids = self._slots[(table_name, tuple(keys))]
+        pos = np.searchsorted(known, hashes)
+        pos[pos == len(known)] = 0
+        found = (known[pos] == hashes) if len(known) else np.zeros(len(hashes), dtype=bool)
+        return ids, pos, found
+
+    def missing(self, table_name, keys, hashes):
+        """Máscara dos hashes que ainda não estão no cache."""
+        return ~self._positions(table_name, keys, hashes)[2]
+
+    def lookup(self, table_name, keys, hashes) -> pd.arrays.IntegerArray:
+        """Ids correspondentes aos hashes, na mesma ordem (Int64, <NA> onde a chave não existe)."""
+        ids, pos, found = self._positions(table_name, keys, hashes)
+        values = ids[pos] if len(ids) else np.zeros(len(hashes), dtype=np.int64)
+        return pd.arrays.IntegerArray(values, ~found)
+
+    def add(self, table_name, keys, id_col, df_new):
+        slot = (table_name, tuple(keys))
+        hashes, new_ids = key_hash(df_new, keys), df_new[id_col].to_numpy(dtype=np.int64)
+        with self._lock:
+            if slot not in self._slots:
+                self._slots[slot] = (np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.int64))
+            # Cargas paralelas podem resolver a mesma chave: só entram hashes ainda ausentes
+            fresh = self.missing(table_name, keys, hashes)
+            known, ids = self._slots[slot]
+            self._slots[slot] = self._sorted(np.concatenate([known, hashes[fresh]]), np.concatenate([ids, new_ids[fresh]]))
+
+    def size(self, table_name, keys):
+        return len(self._slots[(table_name, tuple(keys))][0])
+
+class SchemaRegistry:
+    """Colunas de cada tabela, lidas do catálogo uma única vez por execução.
+
+    O ensure_table consulta o registro em vez do inspector; só as tabelas que
+    ele mesmo cria ou altera são atualizadas aqui. Lido de pg_attribute para
+    incluir também views materializadas. As entradas são por (schema, relação):
+    um nome sem schema é o do schema atual (o star schema) e "consulta.leitos"
+    chega às relações do QUERY_SCHEMA, sem que uma esconda a outra.
+    """
+    def __init__(self, engine, schemas=(QUERY_SCHEMA,)):
+        self.engine = engine
+        self.schemas = list(schemas)
+        self._tables = None
+        self._default = None
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self._tables = None
+
+    def _load(self):
+        tables = defaultdict(set)
+        with self.engine.connect() as conn:
+            self._default = conn.execute(text("SELECT current_schema()")).scalar()
+            rows = conn.execute(text(
+                "SELECT n.nspname, c.relname, a.attname FROM pg_attribute a "
+                "JOIN pg_class c ON c.oid = a.attrelid JOIN pg_namespace n ON n.oid = c.relnamespace "
+                "WHERE (n.nspname = current_schema() OR n.nspname = ANY(:schemas)) "
+                "AND c.relkind IN ('r', 'p', 'v', 'm', 'f') "
+                "AND a.attnum > 0 AND NOT a.attisdropped"
+            ), {"schemas": self.schemas})
+            for nsp, t_name, col in rows:
+                tables[(nsp, t_name.lower())].add(col.lower())
+        logging.info(f"🗂️ Catálogo carregado: {len(tables)} tabelas")
+        return dict(tables)
+
+    def _key(self, table_name):
+        schema, _, relname = table_name.lower().rpartition(".")
+        return (schema or self._default, relname)
+
+    def columns(self, table_name):
+        """Colunas conhecidas da tabela ("schema.tabela" ou só o nome, no schema
+        atual), ou None se ela não existe."""
+        with self._lock:
+            if self._tables is None:
+                self._tables = self._load()
+            return self._tables.get(self._key(table_name))
+
+    def has_table(self, table_name):
+        return self.columns(table_name) is not None
+
+    def record(self, table_name, columns):
+        with self._lock:
+            if self._tables is None: return
+            self._tables.setdefault(self._key(table_name), set()).update(c.lower() for c in columns)
+
+    def forget(self, table_name):
+        with self._lock:
+            if self._tables is not None:
+                self._tables.pop(self._key(table_name), None)
+
+class RollupCubes:
+    """Cubos de ROLLUPS: DDL, carga inicial e os upserts incrementais.
+
+    Os upserts rodam na transação de quem chama (o COPY do lote ou o DELETE de
+    um recurso), então o cubo nunca diverge da fato. Um cubo só recebe deltas
+    depois de ensure(), que o cria e preenche a partir da fato já carregada.
+    """
+    def __init__(self, engine, schema: SchemaRegistry, cubes=None, schema_name=QUERY_SCHEMA):
+        self.engine = engine
+        self.schema = schema
+        self.cubes = ROLLUPS if cubes is None else cubes
+        self.schema_name = schema_name
+        self._ready = set()
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self._ready.clear()
+
+    def qualified(self, name):
+        return f"{self.schema_name}.{name}"
+
+    def for_fact(self, fact_table):
+        """Cubos prontos para receber deltas da fato."""
+        fact_table = fact_table.lower()
+        return [name for name, cube in self.cubes.items() if cube["fact"] == fact_table and name in self._ready]
+
+    def fact_columns(self, fact_table):
+        """Colunas da fato que os cubos usam (as que o staging do lote precisa ter)."""
+        cols = set()
+        for cube in self.cubes.values():
+            if cube["fact"] != fact_table.lower(): continue
+            exprs = [e for e, _ in cube["grain"].values()] + [e for _, e in cube["measures"].values()]
+            exprs += [cond for _, _, cond in cube["joins"]]
+            for expr in exprs:
+                cols.update(re.findall(r'\bf\.(\w+)', expr))
+        return sorted(cols)
+
+    def upsert_sql(self, name, source, where="", sign=1):
+        """Agrega `source` (aliased f) no grão do cubo e soma (sign=1) ou subtrai (sign=-1) no cubo."""
+        cube = self.cubes[name]
+        grain, measures = list(cube["grain"]), list(cube["measures"]) + ["linhas"]
+        exprs = [expr for expr, _ in cube["grain"].values()]
+        for agg, expr in cube["measures"].values():
+            exprs.append(f"{sign} * COALESCE(SUM({expr}), 0)" if agg == "sum" else f"{sign} * COUNT({expr})")
+        exprs.append(f"{sign} * COUNT(*)")
+        joins = " ".join(f"LEFT JOIN {t} {alias} ON {cond}" for t, alias, cond in cube["joins"])
+        positions = ", ".join(str(i + 1) for i in range(len(grain)))
+        updates = ", ".join(f"{m} = r.{m} + EXCLUDED.{m}" for m in measures)
+        # ORDER BY: cargas paralelas da mesma fato travam as linhas do cubo na mesma ordem
+        return (f"INSERT INTO {self.qualified(name)} AS r ({', '.join(grain + measures)}) "
+                f"SELECT {', '.join(exprs)} FROM {source} f {joins} {where} "
+                f"GROUP BY {positions} ORDER BY {positions} "
+                f"ON CONFLICT ({', '.join(grain)}) DO UPDATE SET {updates}")
+
+    def ensure(self, fact_table):
+        """Cria os cubos da fato que ainda não existem, já preenchidos com o que a fato
+        tem. Roda em transação própria, antes do lote, para que as cargas paralelas
+        só enviem deltas a cubos já confirmados.
+
+        A criação trava a fato em SHARE ROW EXCLUSIVE: espera os lotes em andamento
+        (o COPY segura ROW EXCLUSIVE até o commit), para que a carga inicial veja as
+        linhas deles, e segura os novos até o cubo ser confirmado. O cubo entra em
+        _ready ainda nessa transação: um lote que esperava o lock já soma seus deltas."""
+        fact_table = fact_table.lower()
+        exists = "SELECT to_regclass(:t)"
+        with self._lock:
+            for name, cube in self.cubes.items():
+                if cube["fact"] != fact_table or name in self._ready: continue
+                relations = [fact_table] + [t for t, _, _ in cube["joins"]]
+                if not all(self.schema.has_table(t) for t in relations): continue
+                cube_table = self.qualified(name)
+                try:
+                    with self.engine.begin() as conn:
+                        if conn.execute(text(exists), {"t": cube_table}).scalar() is None:
+                            conn.execute(text(f"LOCK TABLE {fact_table} IN SHARE ROW EXCLUSIVE MODE;"))
+                        # Outro processo pode ter criado o cubo enquanto o lock era esperado
+                        if conn.execute(text(exists), {"t": cube_table}).scalar() is None:
+                            cols_ddl = [f"{col} {ctype} NOT NULL" for col, (_, ctype) in cube["grain"].items()]
+                            cols_ddl += [f"{m} {'NUMERIC' if agg == 'sum' else 'BIGINT'} NOT NULL DEFAULT 0"
+                                         for m, (agg, _) in cube["measures"].items()]
+                            cols_ddl += ["linhas BIGINT NOT NULL DEFAULT 0", f"PRIMARY KEY ({', '.join(cube['grain'])})"]
+                            conn.execute(text(f"CREATE SCHEMA IF NOT EXISTS {self.schema_name};"))
+                            conn.execute(text(f"CREATE TABLE {cube_table} ({', '.join(cols_ddl)});"))
+                            groups = conn.execute(text(self.upsert_sql(name, fact_table))).rowcount
+                            logging.info(f"🧊 Cubo {cube_table} criado com {groups} grupos")
+                        self._ready.add(name)
+                    self.schema.record(cube_table, [*cube["grain"], *cube["measures"], "linhas"])
+                except Exception as e:
+                    self._ready.discard(name)
+                    logging.warning(f"⚠️ Cubo {cube_table} indisponível: {e}")
+
+class DBMetrics:
+    """Métricas do acesso ao banco: espera por conexão do pool, latência de commit
+    (contagem, total e máximo) e contadores (checkouts, deadlocks)."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._timings = defaultdict(lambda: [0, 0.0, 0.0])
+        self.counters = Counter()
+
+    def observe(self, name, seconds):
+        with self._lock:
+            timing = self._timings[name]
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2], seconds)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def snapshot(self):
+        with self._lock:
+            timings = {name: {"n": n, "total_s": round(total, 4), "avg_ms": round(1000 * total / n, 2) if n else 0.0,
+                              "max_ms": round(1000 * peak, 2)}
+                       for name, (n, total, peak) in self._timings.items()}
+            return {"timings": timings, "counters": dict(self.counters)}
+
+class UnitOfWork:
+    """Uma conexão do pool e uma transação para todas as escritas de um lote:
+    dimensões, leitura de ids, fato, cubos e checkpoint são confirmados juntos.
+
+    Os ids criados na transação ficam em `pending` e só entram no dim_cache
+    depois do commit; até lá, lookup() consulta os dois. Assim nenhuma outra
+    carga usa um id que ainda pode sofrer rollback.
+    """
+    def __init__(self, db):
+        self.db = db
+        self.raw = None
+        self.pending = DimensionCache()
+        self._added = []
+
+    def __enter__(self):
+        start = time.perf_counter()
+        self.raw = self.db.engine.raw_connection()
+        self.db.metrics.observe("checkout_wait", time.perf_counter() - start)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                start = time.perf_counter()
+                self.raw.commit()
+                self.db.metrics.observe("commit", time.perf_counter() - start)
+                for args in self._added:
+                    self.db.dim_cache.add(*args)
+            else:
+                self.raw.rollback()
+        finally:
+            self.raw.close()
+        return False
+
+    def cursor(self):
+        return self.raw.cursor()
+
+    def add_ids(self, table_name, keys, id_col, df_ids):
+        self.pending.add(table_name, keys, id_col, df_ids)
+        self._added.append((table_name, keys, id_col, df_ids))
+
+    def lookup(self, table_name, keys, hashes) -> pd.arrays.IntegerArray:
+        """Como DimensionCache.lookup, incluindo os ids ainda não confirmados desta transação."""
+        ids = self.db.dim_cache.lookup(table_name, keys, hashes)
+        if self.pending.is_loaded(table_name, keys) and ids.isna().any():
+            ids = pd.Series(ids).fillna(pd.Series(self.pending.lookup(table_name, keys, hashes))).array
+        return ids
+
 class SGBDLoader:
-    def __init__(self, connection_string):
-        self.engine = create_engine(connection_string, pool_pre_ping=True)
+    def __init__(self, connection_string, pool_options=None):
+        self.engine = create_engine(connection_string, pool_pre_ping=True, **{**DB_POOL, **(pool_options or {})})
+        self.metrics = DBMetrics()
+        event.listen(self.engine, "checkout", lambda *args: self.metrics.count("checkouts"))
+        # Buffer do COPY reaproveitado entre lotes (um por thread de carga)
+        self._local = threading.local()
+        self.dim_cache = DimensionCache()
+        self.schema = SchemaRegistry(self.engine)
+        self._table_locks = defaultdict(threading.Lock)
+        self._locks_guard = threading.Lock()
+        self._checkpoint_ready = False
+        # (tabela, chaves) -> se há índice único nas chaves naturais (habilita o upsert no servidor)
+        self._unique_keys = {}
+        # tabela -> partições de data já existentes (None = tabela não particionada)
+        self._partitions = {}
+        # tabela -> índices secundários sugeridos pelo index_advisor (criados no ensure_table)
+        self._index_plan = defaultdict(list)
+        self._indexes_ready = set()
+        # Cubos de agregação atualizados junto com cada lote da fato
+        self.rollups = RollupCubes(self.engine, self.schema)
+
+    @contextmanager
+    def unit_of_work(self, outer=None):
+        """Unidade de trabalho nova, ou `outer` se o chamador já está dentro de uma
+        (aí o commit fica com quem abriu)."""
+        if outer is not None:
+            yield outer
+            return
+        with UnitOfWork(self) as uow:
+            yield uow
+
+    def pool_status(self):
+        return self.engine.pool.status()
+
+    def reset_caches(self):
+        """Descarta caches da execução (após reset_environment, por exemplo)."""
+        self.dim_cache.clear()
+        self.schema.clear()
+        self._unique_keys.clear()
+        self._partitions.clear()
+        self._indexes_ready.clear()
+        self.rollups.clear()
+
+    def table_lock(self, table_name):
+        """Lock por tabela: serializa DDL e sincronização de dimensões entre cargas paralelas."""
+        with self._locks_guard:
+            return self._table_locks[table_name.lower()]
+
+    @property
+    def _copy_buffer(self):
+        if not hasattr(self._local, "copy_buffer"):
+            self._local.copy_buffer = io.StringIO()
+        return self._local.copy_buffer
+
+    def _csv_buffer(self, df: pd.DataFrame):
+        """Serializa df no buffer do COPY da thread (CSV, nulos como \\N)."""
+        buf = self._copy_buffer
+        buf.seek(0)
+        buf.truncate(0)
+        # \N marca nulos; string vazia continua sendo string vazia (como no to_sql)
+        df.to_csv(buf, index=False, header=False, sep=',', na_rep='\\N')
+        buf.seek(0)
+        return buf
+
+    def ensure_table(self, table_name, schema_mapping, keys=None, lookups=None, pk_col=None, extra_columns=None,
+                     partition=None):
+        with self.table_lock(table_name):
+            self._ensure_table(table_name, schema_mapping, keys, lookups, pk_col, extra_columns, partition)
+            if keys: self._ensure_unique_keys(table_name, keys)
+            if self._index_plan: self._ensure_indexes(table_name)
 
-    def ensure_table(self, table_name, schema_mapping, keys=None, lookups=None, pk_col=None):
+    @staticmethod
+    def index_name(table_name, columns, method="btree"):
+        # O índice fica no schema da relação: o nome leva só o da relação
+        digest = hashlib.md5(f"{method}:{','.join(columns)}".encode()).hexdigest()[:8]
+        return f"ix_{table_name.rpartition('.')[2]}_{digest}"
+
+    def plan_indexes(self, proposals):
+        """Registra índices secundários (dicts com table, columns e method, como os
+        devolvidos por index_advisor.advise). Cada um é criado pelo
+        ensure_table/ensure_indexes assim que a tabela tiver todas as colunas; os
+        das views de consulta vêm com o schema no nome e ficam com o QueryViews."""
+        for spec in proposals:
+            self._index_plan[spec["table"].lower()].append(spec)
+
+    def ensure_indexes(self, table_name):
+        with self.table_lock(table_name):
+            return self._ensure_indexes(table_name)
+
+    def _ensure_indexes(self, table_name):
+        table_name = table_name.lower()
+        created = []
+        for spec in self._index_plan.get(table_name, []):
+            columns = [c.lower() for c in spec["columns"]]
+            method = spec.get("method", "btree")
+            name = self.index_name(table_name, columns, method)
+            if name in self._indexes_ready: continue
+            existing = self.schema.columns(table_name)
+            if existing is None or not set(columns) <= existing: continue
+            try:
+                with self.engine.begin() as conn:
+                    conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {table_name} USING {method} ({', '.join(columns)});"))
+                logging.info(f"📇 Índice {name} ({method}: {', '.join(columns)}) garantido em {table_name}")
+                created.append(name)
+            except Exception as e:
+                logging.warning(f"⚠️ Índice {name} não criado em {table_name}: {e}")
+            self._indexes_ready.add(name)
+        return created
+
+    @staticmethod
+    def partition_periods(values: pd.Series, interval="year"):
+        """Períodos (sufixo, início, fim) cobertos pelas datas de `values`."""
+        dates = pd.to_datetime(values, errors='coerce', utc=True).dropna().dt.tz_localize(None)
+        monthly = interval == "month"
+        periods = dates.dt.to_period("M" if monthly else "Y").unique()
+        return sorted((p.strftime("%Y%m" if monthly else "%Y"), p.start_time.strftime("%Y-%m-%d"),
+                       (p + 1).start_time.strftime("%Y-%m-%d")) for p in periods)
+
+    def ensure_partitions(self, table_name, partition, values: pd.Series):
+        """Cria as partições de faixa de data que o lote vai ocupar (antes do COPY).
+        Tabelas criadas sem particionamento (antes desta opção) são deixadas como estão."""
+        table_name = table_name.lower()
+        with self.table_lock(table_name):
+            if table_name not in self._partitions:
+                with self.engine.connect() as conn:
+                    rows = conn.execute(text(
+                        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                        "WHERE i.inhparent = to_regclass(:t)"), {"t": table_name}).fetchall()
+                    is_partitioned = conn.execute(text(
+                        "SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:t)"), {"t": table_name}).first()
+                self._partitions[table_name] = {r[0] for r in rows} if is_partitioned else None
+            known = self._partitions[table_name]
+            if known is None: return 0
+
+            created = 0
+            for suffix, start, end in self.partition_periods(values, partition.get("interval", "year")):
+                part_name = f"{table_name}_{suffix}"
+                if part_name in known: continue
+                try:
+                    with self.engine.begin() as conn:
+                        conn.execute(text(f"CREATE TABLE IF NOT EXISTS {part_name} PARTITION OF {table_name} "
+                                          f"FOR VALUES FROM ('{start}') TO ('{end}');"))
+                    created += 1
+                    logging.info(f"🧩 Partição {part_name} criada")
+                except Exception as e:
+                    # Ex: a default já tem linhas dessa faixa; elas seguem na default
+                    logging.warning(f"⚠️ Partição {part_name} não criada: {e}")
+                known.add(part_name)
+            return created
+
+    @staticmethod
+    def unique_index_name(table_name, keys):
+        # Sufixo curto e estável: o nome cabe em 63 caracteres e cada conjunto de chaves tem o seu
+        digest = hashlib.md5(",".join(keys).encode()).hexdigest()[:8]
+        return f"ux_{table_name}_{digest}"
+
+    def _ensure_unique_keys(self, table_name, keys):
+        """Cria (uma vez por execução) o índice único das chaves naturais da dimensão.
+
+        Dimensões compartilhadas entre pipelines (ex: instituicao por codigo_cnes e
+        por cnpj_instituicao) ganham um índice por conjunto de chaves; como NULLs são
+        distintos no índice, as linhas de um pipeline não conflitam com as do outro.
+        Se a tabela já tiver chaves duplicadas, o índice não é criado e a sincronização
+        continua pelo caminho antigo (inserção filtrada no cliente).
+        """
+        table_name, keys = table_name.lower(), tuple(k.lower() for k in keys)
+        slot = (table_name, keys)
+        if slot in self._unique_keys: return self._unique_keys[slot]
+
+        index_name = self.unique_index_name(table_name, keys)
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(text(f"CREATE UNIQUE INDEX IF NOT EXISTS {index_name} ON {table_name} ({', '.join(keys)});"))
+            self._unique_keys[slot] = True
+        except Exception as e:
+            logging.warning(f"⚠️ Índice único {index_name} ({', '.join(keys)}) não criado em {table_name}: {e}. "
+                            "Sincronização seguirá sem upsert no servidor.")
+            self._unique_keys[slot] = False
+        return self._unique_keys[slot]
+
+    def _ensure_table(self, table_name, schema_mapping, keys=None, lookups=None, pk_col=None, extra_columns=None,
+                      partition=None):
         table_name = table_name.lower()
-        inspector = inspect(self.engine)
         
         desired_columns = {}
         if pk_col: desired_columns[pk_col.lower()] = "SERIAL PRIMARY KEY"
@@ -420,19 +1286,44 @@ class SGBDLoader:
                 fk_col = info.get("target_id_col", info.get("target_fk")).lower()
                 desired_columns[fk_col] = "INTEGER"
 
-        # 4. Criação/Alteração da Tabela
-        if not inspector.has_table(table_name):
-            cols_ddl = [f"{col} {ctype}" for col, ctype in desired_columns.items()]
-            ddl = f"CREATE TABLE {table_name} ({', '.join(cols_ddl)});"
-            with self.engine.begin() as conn: conn.execute(text(ddl))
-            logging.info(f"🆕 Tabela {table_name} criada com schema completo.")
-        else:
-            existing_cols = [c['name'].lower() for c in inspector.get_columns(table_name)]
-            with self.engine.begin() as conn:
-                for col, ctype in desired_columns.items():
-                    if col not in existing_cols:
-                        logging.info(f"⚙️ Adicionando coluna faltante {col} em {table_name}")
-                        conn.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {col} {ctype};"))
+        # 3.1 Colunas de controle (ex: arquivo_origem_id nas fatos)
+        if extra_columns:
+            for col, ctype in extra_columns.items():
+                desired_columns[col.lower()] = ctype
+
+        # 4. Criação/Alteração da Tabela (contra o registro; sem ida ao catálogo)
+        existing_cols = self.schema.columns(table_name)
+        if existing_cols is None:
+            if partition:
+                # A PK de uma tabela particionada teria que incluir a coluna de data (que
+                # pode ser nula); o id continua vindo da sequência, só sem a constraint.
+                if pk_col: desired_columns[pk_col.lower()] = "SERIAL"
+                cols_ddl = [f"{col} {ctype}" for col, ctype in desired_columns.items()]
+                part_col = partition["column"].lower()
+                with self.engine.begin() as conn:
+                    conn.execute(text(f"CREATE TABLE IF NOT EXISTS {table_name} ({', '.join(cols_ddl)}) "
+                                      f"PARTITION BY RANGE ({part_col});"))
+                    # Datas nulas (ou fora das partições criadas) caem na partição default
+                    conn.execute(text(f"CREATE TABLE IF NOT EXISTS {table_name}_default PARTITION OF {table_name} DEFAULT;"))
+                logging.info(f"🆕 Tabela {table_name} criada, particionada por {part_col} ({partition.get('interval', 'year')}).")
+            else:
+                cols_ddl = [f"{col} {ctype}" for col, ctype in desired_columns.items()]
+                ddl = f"CREATE TABLE IF NOT EXISTS {table_name} ({', '.join(cols_ddl)});"
+                with self.engine.begin() as conn: conn.execute(text(ddl))
+                logging.info(f"🆕 Tabela {table_name} criada com schema completo.")
+            # Se a tabela já existia (criada por outro processo), relê do catálogo
+            self.schema.clear()
+            return
+
+        missing = {col: ctype for col, ctype in desired_columns.items() if col not in existing_cols}
+        if not missing: return
+
+        # Todas as colunas faltantes em uma única transação
+        with self.engine.begin() as conn:
+            for col, ctype in missing.items():
+                logging.info(f"⚙️ Adicionando coluna faltante {col} em {table_name}")
+                conn.execute(text(f"ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS {col} {ctype};"))
+        self.schema.record(table_name, missing)
                         
     def sync_dimension(self, df_source: pd.DataFrame, table_name: str, keys: list, id_col: str):
         table_name, id_col = table_name.lower(), id_col.lower()
@@ -462,184 +1353,1035 @@ class SGBDLoader:
 
         return df_db, len(df_to_insert)
 
-    def sync_dimension_full(self, df_source: pd.DataFrame, table_name: str, keys: list, id_col: str):
+    def sync_dimension_full(self, df_source: pd.DataFrame, table_name: str, keys: list, id_col: str, hashes=None,
+                            uow=None):
+        """Garante as linhas de df_source na dimensão e deixa seus ids no dim_cache.
+        `hashes` (opcional) são os key_hash das linhas, já calculados na transformação.
+
+        Dentro de uma unidade de trabalho (`uow`) nada é confirmado aqui e nenhum
+        lock de tabela é mantido: os ids novos ficam pendentes na uow e cargas
+        concorrentes se resolvem pelo índice único (ON CONFLICT). Sem `uow`, a
+        chamada é uma transação própria, serializada pelo lock da tabela.
+        """
+        if uow is not None:
+            return self._sync_dimension_full(df_source, table_name, keys, id_col, hashes, uow)
+        with self.table_lock(table_name), self.unit_of_work() as own:
+            return self._sync_dimension_full(df_source, table_name, keys, id_col, hashes, own)
+
+    def _sync_dimension_full(self, df_source: pd.DataFrame, table_name: str, keys: list, id_col: str, hashes, uow):
         table_name, id_col = table_name.lower(), id_col.lower()
         df_source.columns = [c.lower() for c in df_source.columns]
-        
-        try:
-            df_db = pd.read_sql(f"SELECT {', '.join([id_col] + keys)} FROM {table_name}", self.engine)
-            df_db.columns = [c.lower() for c in df_db.columns]
-        except:
+        if hashes is None: hashes = key_hash(df_source, keys)
+
+        # Leitura completa da dimensão apenas na primeira vez da execução
+        if not self.dim_cache.is_loaded(table_name, keys):
             df_db = pd.DataFrame(columns=[id_col] + keys)
+            if self.schema.has_table(table_name):
+                with uow.cursor() as cur:
+                    cur.execute(f"SELECT {', '.join([id_col] + keys)} FROM {table_name}")
+                    df_db = pd.DataFrame(cur.fetchall(), columns=[id_col] + keys)
+            self.dim_cache.load(table_name, keys, id_col, df_db)
 
         # Identifica o que é novo
-        df_merge = df_source.merge(df_db, on=keys, how='left', indicator=True)
-        df_to_insert = df_merge[df_merge['_merge'] == 'left_only'].drop(columns=['_merge', id_col], errors='ignore')
+        df_to_insert = df_source[self.dim_cache.missing(table_name, keys, hashes)].drop(columns=[id_col], errors='ignore')
 
+        inserted = 0
         if not df_to_insert.empty:
-            logging.info(f"➕ Inserindo {len(df_to_insert)} registros em {table_name}")
-            df_to_insert.to_sql(table_name, self.engine, if_exists='append', index=False, method='multi')
-            
-            # Recarrega para ter os IDs novos
-            df_db = pd.read_sql(f"SELECT {', '.join([id_col] + keys)} FROM {table_name}", self.engine)
-            df_db.columns = [c.lower() for c in df_db.columns]
-
-        return df_db, len(df_to_insert)
+            df_new_ids, inserted = self.upsert_dimension(df_to_insert, table_name, keys, id_col, uow)
+            logging.info(f"➕ {inserted} registros inseridos em {table_name} ({len(df_to_insert)} candidatos)")
+            uow.add_ids(table_name, keys, id_col, df_new_ids)
+
+        return inserted
+
+    def upsert_dimension(self, df: pd.DataFrame, table_name: str, keys: list, id_col: str, uow=None):
+        """Insere as linhas novas da dimensão no servidor: COPY para uma tabela
+        temporária e INSERT ... ON CONFLICT DO NOTHING contra o índice único das chaves
+        (INSERT simples se a dimensão não tem o índice, ver _ensure_unique_keys).
+
+        Devolve (id + chaves de todas as linhas do lote, quantidade inserida). Linhas
+        que já existiam (inseridas por outra carga desde a leitura do cache) voltam
+        com o id existente em vez de duplicar a dimensão.
+        """
+        stage = f"stg_{table_name}"
+        cols = ', '.join(df.columns)
+        key_cols = ', '.join(keys)
+        on_keys = ' AND '.join(f"d.{k} = s.{k}" for k in keys)
+        existing_sql = (f"SELECT d.{id_col}, {', '.join(f'd.{k}' for k in keys)}, FALSE "
+                        f"FROM {table_name} d JOIN {stage} s ON {on_keys}")
+
+        buf = self._csv_buffer(df)
+
+        with self.unit_of_work(uow) as work, work.cursor() as cur:
+            cur.execute(f"CREATE TEMP TABLE {stage} ON COMMIT DROP AS SELECT {cols} FROM {table_name} WITH NO DATA")
+            cur.copy_expert(f"COPY {stage} ({cols}) FROM STDIN WITH (FORMAT csv, NULL '\\N')", buf)
+            if self._unique_keys.get((table_name, tuple(keys))):
+                # A leitura final usa o snapshot do início do comando: as linhas criadas
+                # pelo INSERT vêm só do RETURNING e as já existentes só do JOIN.
+                # ORDER BY: transações concorrentes disputam as chaves na mesma ordem.
+                cur.execute(f"""
+                    WITH novos AS (
+                        INSERT INTO {table_name} ({cols}) SELECT {cols} FROM {stage} ORDER BY {key_cols}
+                        ON CONFLICT ({key_cols}) DO NOTHING
+                        RETURNING {id_col}, {key_cols}
+                    )
+                    SELECT {id_col}, {key_cols}, TRUE FROM novos
+                    UNION ALL
+                    {existing_sql}""")
+                rows = cur.fetchall()
+                if len(rows) < len(df):
+                    # Chaves que outra transação confirmou enquanto esta esperava no
+                    # ON CONFLICT: não estão em nenhum dos dois lados; um novo comando
+                    # (snapshot novo) as encontra.
+                    cur.execute(existing_sql)
+                    seen = {tuple(r[1:-1]) for r in rows}
+                    rows += [r for r in cur.fetchall() if tuple(r[1:-1]) not in seen]
+            else:
+                cur.execute(f"INSERT INTO {table_name} ({cols}) SELECT {cols} FROM {stage} "
+                            f"RETURNING {id_col}, {key_cols}, TRUE")
+                rows = cur.fetchall()
+            cur.execute(f"DROP TABLE {stage}")
+
+        df_ids = pd.DataFrame(rows, columns=[id_col] + keys + ["_novo"])
+        inserted = int(df_ids.pop("_novo").sum())
+        return df_ids, inserted
+
+    def delete_source(self, table_name: str, source_id: int):
+        """Remove as linhas de uma fato que vieram de um recurso (reprocessamento de
+        arquivo alterado), junto com os checkpoints desse recurso."""
+        table_name = table_name.lower()
+        self.ensure_checkpoint_table()
+        if self.schema.has_table(table_name): self.rollups.ensure(table_name)
+        with self.engine.begin() as conn:
+            deleted = 0
+            if self.schema.has_table(table_name):
+                # A contribuição das linhas removidas sai dos cubos na mesma transação
+                for name in self.rollups.for_fact(table_name):
+                    conn.execute(text(self.rollups.upsert_sql(name, table_name, "WHERE f.arquivo_origem_id = :sid", sign=-1)),
+                                 {"sid": source_id})
+                    conn.execute(text(f"DELETE FROM {self.rollups.qualified(name)} WHERE linhas <= 0;"))
+                deleted = conn.execute(text(f"DELETE FROM {table_name} WHERE arquivo_origem_id = :sid"), {"sid": source_id}).rowcount
+            conn.execute(text(f"DELETE FROM {CHECKPOINT_TABLE} WHERE arquivo_origem_id = :sid"), {"sid": source_id})
+        logging.info(f"🗑️ {deleted} linhas antigas removidas de {table_name}")
+        return deleted
+
+    def untagged_fact_tables(self, tables, include_rows=False):
+        """Fatos criadas antes do rastreio por recurso (sem a coluna
+        arquivo_origem_id). Com `include_rows`, também as que têm linhas com
+        arquivo_origem_id nulo (ex: cargas de caminho local), que prepare_source
+        não consegue substituir."""
+        untagged = []
+        with self.engine.connect() as conn:
+            for table_name in tables:
+                cols = self.schema.columns(table_name)
+                if cols is None: continue
+                if "arquivo_origem_id" not in cols or (include_rows and conn.execute(text(
+                        f"SELECT EXISTS (SELECT 1 FROM {table_name} WHERE arquivo_origem_id IS NULL)")).scalar()):
+                    untagged.append(table_name.lower())
+        return untagged
+
+    # --- CHECKPOINTS POR LOTE ---
+    def ensure_checkpoint_table(self):
+        if self._checkpoint_ready: return
+        with self.table_lock(CHECKPOINT_TABLE), self.engine.begin() as conn:
+            conn.execute(text(f"""
+                CREATE TABLE IF NOT EXISTS {CHECKPOINT_TABLE} (
+                    arquivo_origem_id BIGINT NOT NULL,
+                    versao TEXT NOT NULL,
+                    lote INTEGER NOT NULL,
+                    linha_final BIGINT NOT NULL,
+                    tabela TEXT,
+                    concluido_em TIMESTAMPTZ DEFAULT now(),
+                    PRIMARY KEY (arquivo_origem_id, versao, lote)
+                );"""))
+        self._checkpoint_ready = True
+
+    def prepare_source(self, table_name: str, source_id: int, version: str, replace: bool = False, restart: bool = False):
+        """Devolve quantas linhas do arquivo já estão carregadas e podem ser puladas.
+
+        Só há retomada se os checkpoints existentes forem da mesma versão do
+        arquivo; restos de outra versão (ou `replace` sem checkpoints da versão
+        atual) são apagados e a carga recomeça do zero. `restart` apaga o que
+        houver mesmo na mesma versão (recarga a partir do staging).
+        """
+        self.ensure_checkpoint_table()
+        with self.engine.connect() as conn:
+            rows = conn.execute(text(
+                f"SELECT versao, MAX(linha_final) FROM {CHECKPOINT_TABLE} WHERE arquivo_origem_id = :sid GROUP BY versao"
+            ), {"sid": source_id}).fetchall()
+        offsets = dict(rows)
+
+        if set(offsets) == {version} and not restart:
+            return int(offsets[version])
+        if offsets or replace or restart:
+            self.delete_source(table_name, source_id)
+        return 0
 
-    def load_fact(self, df: pd.DataFrame, table_name: str):
-        if df.empty: return 0
-        df.columns = [c.lower() for c in df.columns]
-        logging.info(f"📊 Fato {table_name}: {len(df)} linhas")
-        df.to_sql(table_name.lower(), self.engine, if_exists='append', index=False, method='multi', chunksize=2000)
+    @staticmethod
+    def checkpoint_params(checkpoint):
+        return {k: checkpoint[k] for k in ("arquivo_origem_id", "versao", "lote", "linha_final", "tabela")}
+
+    def write_checkpoint(self, cur, checkpoint):
+        cur.execute(
+            f"INSERT INTO {CHECKPOINT_TABLE} (arquivo_origem_id, versao, lote, linha_final, tabela) "
+            "VALUES (%(arquivo_origem_id)s, %(versao)s, %(lote)s, %(linha_final)s, %(tabela)s)",
+            self.checkpoint_params(checkpoint))
+
+    def copy_dataframe(self, df: pd.DataFrame, table_name: str, checkpoint=None, uow=None):
+        """Carrega o DataFrame via COPY FROM STDIN na conexão psycopg2 crua.
+        Cubos e checkpoint do lote (se houver) são gravados na mesma transação."""
+        buf = self._csv_buffer(df)
+
+        cols = ', '.join(df.columns)
+        sql = f"COPY {table_name} ({cols}) FROM STDIN WITH (FORMAT csv, NULL '\\N')"
+        with self.unit_of_work(uow) as work, work.cursor() as cur:
+            cur.copy_expert(sql, buf)
+            self._apply_rollups(cur, df, table_name)
+            if checkpoint: self.write_checkpoint(cur, checkpoint)
+
+    def _apply_rollups(self, cur, df: pd.DataFrame, table_name: str):
+        """Soma o lote aos cubos da fato, na transação do cursor: as colunas usadas
+        vão para uma tabela temporária e cada cubo recebe um upsert agregado."""
+        cubes = self.rollups.for_fact(table_name)
+        if not cubes: return
+        cols = self.rollups.fact_columns(table_name)
+        stg = f"stg_rollup_{table_name}"
+        cur.execute(f"CREATE TEMP TABLE {stg} ON COMMIT DROP AS SELECT {', '.join(cols)} FROM {table_name} WITH NO DATA")
+        present = [c for c in cols if c in df.columns]
+        cur.copy_expert(f"COPY {stg} ({', '.join(present)}) FROM STDIN WITH (FORMAT csv, NULL '\\N')",
+                        self._csv_buffer(df[present]))
+        for name in cubes:
+            cur.execute(self.rollups.upsert_sql(name, stg))
+
+    def load_fact(self, df: pd.DataFrame, table_name: str, method: str = "multi", checkpoint=None, uow=None):
+        """Carrega um lote da fato. Com `checkpoint`, fato e checkpoint são
+        confirmados na mesma transação: ou o lote inteiro entra, ou nada entra.
+        O mesmo vale para os cubos de agregação da fato (ROLLUPS) e, dentro de
+        uma unidade de trabalho (`uow`), para as dimensões do lote.
+
+        DDL não roda dentro de uma uow: quem passa `uow` já chamou
+        ensure_checkpoint_table e rollups.ensure antes de abri-la."""
+        if uow is None:
+            if checkpoint: self.ensure_checkpoint_table()
+            self.rollups.ensure(table_name)
+        with self.unit_of_work(uow) as work:
+            if df.empty:
+                if checkpoint:
+                    with work.cursor() as cur: self.write_checkpoint(cur, checkpoint)
+                return 0
+            df.columns = [c.lower() for c in df.columns]
+            table_name = table_name.lower()
+            logging.info(f"📊 Fato {table_name}: {len(df)} linhas ({method})")
+
+            if method == "copy":
+                # Sem repetir o lote via INSERT: um valor que o COPY recusa (o erro diz a
+                # linha e a coluna) o INSERT também recusaria. O lote falha inteiro, com as
+                # dimensões; load_method "multi" na config segue disponível como caminho antigo
+                self.copy_dataframe(df, table_name, checkpoint=checkpoint, uow=work)
+                return len(df)
+
+            rows = df.astype(object).where(df.notna(), None).itertuples(index=False, name=None)
+            with work.cursor() as cur:
+                execute_values(cur, f"INSERT INTO {table_name} ({', '.join(df.columns)}) VALUES %s", rows, page_size=2000)
+                self._apply_rollups(cur, df, table_name)
+                if checkpoint: self.write_checkpoint(cur, checkpoint)
         return len(df)
 
+def query_view_sql(spec, columns_of, dialect="postgres", schema=None):
+    """SELECT de uma view de QUERY_VIEWS, ou None se a fato ou alguma dimensão
+    ainda não existe. `columns_of(tabela)` devolve as colunas da tabela (ou None);
+    com `schema`, as tabelas do FROM são qualificadas. No DuckDB vale a expressão
+    própria da coluna, quando houver, e as colunas ausentes saem como VARCHAR nulo."""
+    fact_table, fact_alias = spec["fact"]
+    relations = {fact_alias: fact_table, **{alias: t for t, alias, _ in spec["joins"]}}
+    known = {alias: columns_of(t) for alias, t in relations.items()}
+    if any(cols is None for cols in known.values()): return None
+    qualify = (lambda t: f"{schema}.{t}") if schema else (lambda t: t)
+    missing = "NULL::VARCHAR" if dialect == "duckdb" else "NULL"
+
+    exprs = []
+    for col, source in spec["columns"].items():
+        ref, template, *dialects = source if isinstance(source, tuple) else (source, "{}")
+        if dialect == "duckdb" and dialects: template = dialects[0]
+        alias, src_col = ref.split(".")
+        exprs.append(f"{template.format(ref) if src_col in known[alias] else missing} AS {col}")
+    joins = " ".join(f"LEFT JOIN {qualify(t)} {alias} ON {cond}" for t, alias, cond in spec["joins"])
+    return f"SELECT {', '.join(exprs)} FROM {qualify(fact_table)} {fact_alias} {joins}"
+
+class QueryViews:
+    """Views materializadas do schema de consulta (QUERY_VIEWS), mantidas sobre o star schema.
+
+    A definição de cada view depende das colunas que as tabelas já têm; o hash
+    do SELECT fica no COMMENT da view e, quando muda (ex: uma coluna nova na
+    dimensão), a view é recriada. Nos demais casos o refresh é CONCURRENTLY:
+    só as linhas que mudaram são regravadas e as leituras não bloqueiam.
+    """
+    def __init__(self, db: SGBDLoader, views=None, schema_name=QUERY_SCHEMA):
+        self.db = db
+        self.views = views or QUERY_VIEWS
+        self.schema_name = schema_name
+
+    def qualified(self, name):
+        return f"{self.schema_name}.{name}"
+
+    def select_sql(self, name):
+        """SELECT da view, ou None se a fato ou alguma dimensão ainda não existe."""
+        return query_view_sql(self.views[name], self.db.schema.columns)
+
+    def ensure(self, name):
+        """Cria (ou recria, se a definição mudou) a view. Devolve 'created', 'ready' ou None."""
+        sql = self.select_sql(name)
+        if sql is None: return None
+        digest = hashlib.md5(sql.encode()).hexdigest()[:12]
+        view = self.qualified(name)
+        with self.db.engine.connect() as conn:
+            current = conn.execute(text("SELECT obj_description(to_regclass(:v), 'pg_class')"), {"v": view}).scalar()
+        if current == digest:
+            # Índices planejados depois da criação (ADVISE_INDEXES, index_advisor); IF NOT EXISTS
+            self._ensure_indexes(name)
+            return "ready"
+
+        key = self.views[name]["key"]
+        with self.db.engine.begin() as conn:
+            conn.execute(text(f"CREATE SCHEMA IF NOT EXISTS {self.schema_name};"))
+            conn.execute(text(f"DROP MATERIALIZED VIEW IF EXISTS {view};"))
+            conn.execute(text(f"CREATE MATERIALIZED VIEW {view} AS {sql};"))
+            # Índice único exigido pelo REFRESH ... CONCURRENTLY
+            conn.execute(text(f"CREATE UNIQUE INDEX {self.db.unique_index_name(name, [key])} ON {view} ({key});"))
+            conn.execute(text(f"COMMENT ON MATERIALIZED VIEW {view} IS '{digest}';"))
+        self.db.schema.forget(view)
+        self.db.schema.record(view, self.views[name]["columns"])
+        logging.info(f"🪟 View materializada {view} {'recriada' if current else 'criada'}")
+        self._ensure_indexes(name)
+        return "created"
+
+    def _ensure_indexes(self, name):
+        """Índices do index_advisor planejados para a view (chave consulta.<view>:
+        o nome sem schema é a tabela do star schema)."""
+        columns = set(self.views[name]["columns"])
+        for spec in self.db._index_plan.get(self.qualified(name), []):
+            cols = [c.lower() for c in spec["columns"]]
+            if not set(cols) <= columns: continue
+            method = spec.get("method", "btree")
+            try:
+                with self.db.engine.begin() as conn:
+                    conn.execute(text(f"CREATE INDEX IF NOT EXISTS {self.db.index_name(name, cols, method)} "
+                                      f"ON {self.qualified(name)} USING {method} ({', '.join(cols)});"))
+            except Exception as e:
+                logging.warning(f"⚠️ Índice em {self.qualified(name)} ({', '.join(cols)}) não criado: {e}")
+
+    def refresh(self, facts=None):
+        """Atualiza as views cujas fatos estão em `facts` (todas, se None)."""
+        refreshed = []
+        for name, spec in self.views.items():
+            if facts is not None and spec["fact"][0] not in facts: continue
+            try:
+                state = self.ensure(name)
+                if state == "ready":
+                    start = time.time()
+                    with self.db.engine.begin() as conn:
+                        conn.execute(text(f"REFRESH MATERIALIZED VIEW CONCURRENTLY {self.qualified(name)};"))
+                    logging.info(f"🔄 View {self.qualified(name)} atualizada em {time.time() - start:.1f}s")
+                if state: refreshed.append(name)
+            except Exception as e:
+                logging.error(f"❌ Erro ao atualizar a view {self.qualified(name)}: {e}")
+        return refreshed
+
+# Arquivo do espelho DuckDB do star schema (opcional, ver DuckDBMirror)
+DUCKDB_PATH = "datalake.duckdb"
+
+class DuckDBMirror:
+    """Espelho DuckDB do star schema: mesmas tabelas, colunas e ids do Postgres.
+
+    sync() leva ao arquivo só o que mudou, lido num snapshot (REPEATABLE READ)
+    do Postgres e exportado via COPY para um CSV temporário, que o DuckDB anexa
+    com read_csv (carga em massa nativa, tipos explícitos):
+    - dimensões (só crescem): ids do Postgres que o espelho ainda não tem;
+    - fatos: recursos (arquivo_origem_id) cujo checkpoint (versão, último lote)
+      difere do registrado no espelho são apagados e copiados de novo.
+    Uma tabela recriada no Postgres (oid diferente, ex: reset_environment) é
+    copiada do zero; uma tabela apagada some do espelho. As relações de
+    QUERY_VIEWS viram views no schema QUERY_SCHEMA do arquivo, sobre as tabelas
+    espelhadas (quem consulta usa search_path = consulta, main).
+
+    O arquivo publicado nunca é aberto para escrita: cada sync trabalha numa
+    cópia (`path + '.tmp'`), que substitui o original com os.replace (rename
+    atômico). Assim o lock de escrita do DuckDB não conflita com a API, que
+    mantém o arquivo aberto em modo leitura; quem já o tem aberto segue lendo a
+    versão anterior até reabrir (o QueryService reabre quando a DataVersion muda).
+    O preço é copiar o arquivo a cada sync.
+    """
+    STATE_TABLE = "_espelho_origens"
+    TABLES_TABLE = "_espelho_tabelas"
+
+    def __init__(self, db: SGBDLoader, path=DUCKDB_PATH, configs=None, views=None):
+        self.db = db
+        self.path = path
+        self.views = QUERY_VIEWS if views is None else views
+        self.dims, self.facts = {}, {}
+        for config in (configs or CONFIG_MAP).values():
+            for dim in config.get("dimensions", []):
+                self.dims[dim["target_table"].lower()] = dim["id_col"].lower()
+            if "fact" in config:
+                self.facts[config["fact"]["target_table"].lower()] = config["fact"]["id_col"].lower()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _pg_tables(conn):
+        """{tabela: (oid, [(coluna, tipo)])} das tabelas do schema atual, na ordem do Postgres."""
+        tables = {}
+        rows = conn.execute(text(
+            "SELECT c.relname, c.oid::bigint, a.attname, format_type(a.atttypid, a.atttypmod) FROM pg_attribute a "
+            "JOIN pg_class c ON c.oid = a.attrelid JOIN pg_namespace n ON n.oid = c.relnamespace "
+            "WHERE n.nspname = current_schema() AND c.relkind IN ('r', 'p') AND NOT c.relispartition "
+            "AND a.attnum > 0 AND NOT a.attisdropped ORDER BY c.relname, a.attnum"
+        ))
+        for t_name, oid, col, ctype in rows:
+            ctype = {"text": "VARCHAR", "timestamp with time zone": "TIMESTAMPTZ"}.get(ctype, ctype)
+            tables.setdefault(t_name.lower(), (oid, []))[1].append((col.lower(), ctype))
+        return tables
+
+    @staticmethod
+    def _ensure_table(duck, table_name, columns):
+        existing = {r[0] for r in duck.execute(
+            "SELECT column_name FROM information_schema.columns WHERE table_schema = 'main' AND table_name = ?",
+            [table_name]).fetchall()}
+        if not existing:
+            duck.execute(f"CREATE TABLE {table_name} ({', '.join(f'{c} {t}' for c, t in columns)})")
+        for col, ctype in columns:
+            if existing and col not in existing:
+                duck.execute(f"ALTER TABLE {table_name} ADD COLUMN {col} {ctype}")
+
+    @staticmethod
+    def _pull(cur, duck, table_name, columns, where="", params=None, anti_key=None):
+        """Copia as linhas do Postgres que atendem `where` para a tabela do espelho.
+        Com `anti_key`, linhas cujo id o espelho já tem são ignoradas."""
+        names = [c for c, _ in columns]
+        sql = cur.mogrify(f"COPY (SELECT {', '.join(names)} FROM {table_name} {where}) "
+                          "TO STDOUT WITH (FORMAT csv, HEADER, NULL '\\N')", params).decode()
+        fd, tmp_path = tempfile.mkstemp(suffix=".csv")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8", newline="") as f:
+                cur.copy_expert(sql, f)
+            types = ", ".join(f"'{c}': '{t}'" for c, t in columns)
+            source = f"read_csv(?, header = true, nullstr = '\\N', columns = {{{types}}})"
+            select = f"SELECT s.* FROM {source} s" + (f" ANTI JOIN {table_name} USING ({anti_key})" if anti_key else "")
+            return duck.execute(f"INSERT INTO {table_name} ({', '.join(names)}) {select}", [tmp_path]).fetchone()[0]
+        finally:
+            os.remove(tmp_path)
+
+    def _sync_dimension(self, conn, cur, duck, table_name, id_col, columns):
+        pg_ids = np.array([r[0] for r in conn.execute(text(f"SELECT {id_col} FROM {table_name}"))], dtype=np.int64)
+        duck_ids = duck.execute(f"SELECT {id_col} FROM {table_name}").fetchnumpy()[id_col]
+        missing = np.setdiff1d(pg_ids, duck_ids)
+        if not missing.size: return 0
+        # Ids vêm de sequência: a partir do menor faltante, o ANTI JOIN descarta os já espelhados
+        return self._pull(cur, duck, table_name, columns, f"WHERE {id_col} >= %(lo)s", {"lo": int(missing.min())},
+                          anti_key=id_col)
+
+    def _sync_fact(self, conn, cur, duck, table_name, columns):
+        pg_state = {}
+        if conn.execute(text("SELECT to_regclass(:t)"), {"t": CHECKPOINT_TABLE}).scalar() is not None:
+            rows = conn.execute(text(f"SELECT arquivo_origem_id, versao, MAX(lote) FROM {CHECKPOINT_TABLE} "
+                                     "WHERE tabela = :t GROUP BY 1, 2"), {"t": table_name})
+            pg_state = {int(sid): (versao, int(lote)) for sid, versao, lote in rows}
+        mirror_state = {int(sid): (versao, int(lote)) for sid, versao, lote in duck.execute(
+            f"SELECT arquivo_origem_id, versao, lote FROM {self.STATE_TABLE} WHERE tabela = ?", [table_name]).fetchall()}
+
+        changed = sorted(sid for sid in set(pg_state) | set(mirror_state) if pg_state.get(sid) != mirror_state.get(sid))
+        copied = 0
+        if changed:
+            duck.execute(f"DELETE FROM {table_name} WHERE arquivo_origem_id IN (SELECT UNNEST(?))", [changed])
+            duck.execute(f"DELETE FROM {self.STATE_TABLE} WHERE tabela = ? AND arquivo_origem_id IN (SELECT UNNEST(?))",
+                         [table_name, changed])
+            reload = [sid for sid in changed if sid in pg_state]
+            if reload:
+                copied += self._pull(cur, duck, table_name, columns, "WHERE arquivo_origem_id = ANY(%(ids)s)", {"ids": reload})
+                duck.executemany(f"INSERT INTO {self.STATE_TABLE} VALUES (?, ?, ?, ?)",
+                                 [[table_name, sid, *pg_state[sid]] for sid in reload])
+
+        # Cargas sem recurso de origem (arquivo local) não têm checkpoint: compara a contagem
+        pg_null = conn.execute(text(f"SELECT COUNT(*) FROM {table_name} WHERE arquivo_origem_id IS NULL")).scalar()
+        duck_null = duck.execute(f"SELECT COUNT(*) FROM {table_name} WHERE arquivo_origem_id IS NULL").fetchone()[0]
+        if pg_null != duck_null:
+            duck.execute(f"DELETE FROM {table_name} WHERE arquivo_origem_id IS NULL")
+            copied += self._pull(cur, duck, table_name, columns, "WHERE arquivo_origem_id IS NULL")
+        return copied
+
+    def _sync_views(self, duck):
+        """(Re)cria as views de consulta sobre as tabelas espelhadas; a definição
+        acompanha as colunas que o espelho tem no momento."""
+        columns = defaultdict(set)
+        for t_name, col in duck.execute("SELECT table_name, column_name FROM information_schema.columns "
+                                        "WHERE table_schema = 'main'").fetchall():
+            columns[t_name.lower()].add(col.lower())
+        duck.execute(f"CREATE SCHEMA IF NOT EXISTS {QUERY_SCHEMA}")
+        for name, spec in self.views.items():
+            sql = query_view_sql(spec, columns.get, dialect="duckdb", schema="main")
+            if sql is None:
+                duck.execute(f"DROP VIEW IF EXISTS {QUERY_SCHEMA}.{name}")
+            else:
+                duck.execute(f"CREATE OR REPLACE VIEW {QUERY_SCHEMA}.{name} AS {sql}")
+
+    @staticmethod
+    def _discard(path):
+        for p in (path, path + ".wal"):
+            if os.path.exists(p): os.remove(p)
+
+    def _working_copy(self):
+        """Cópia do espelho publicado, onde o sync escreve."""
+        work_path = self.path + ".tmp"
+        self._discard(work_path)
+        if os.path.exists(self.path):
+            shutil.copyfile(self.path, work_path)
+            # WAL de uma escrita interrompida: vai junto e é aplicado na cópia
+            if os.path.exists(self.path + ".wal"):
+                shutil.copyfile(self.path + ".wal", work_path + ".wal")
+        return work_path
+
+    def _publish(self, work_path):
+        # O WAL antigo já está na cópia (CHECKPOINT); ao lado do arquivo novo ele o corromperia
+        if os.path.exists(self.path + ".wal"): os.remove(self.path + ".wal")
+        os.replace(work_path, self.path)
+
+    def sync(self):
+        """Leva ao espelho o estado atual do Postgres. Devolve {tabela: linhas copiadas}."""
+        with self._lock:
+            work_path = self._working_copy()
+            try:
+                copied = self._sync_into(work_path)
+            except Exception:
+                self._discard(work_path)
+                raise
+            self._publish(work_path)
+        changed = {t: n for t, n in copied.items() if n}
+        logging.info(f"🦆 Espelho DuckDB {self.path} sincronizado: {changed or 'sem alterações'}")
+        return copied
+
+    def _sync_into(self, work_path):
+        import duckdb
+
+        copied = {}
+        with duckdb.connect(work_path) as duck, \
+             self.db.engine.connect().execution_options(isolation_level="REPEATABLE READ") as conn:
+            pg_tables = self._pg_tables(conn)
+            cur = conn.connection.cursor()
+            # CSV com datas em ISO, independente do DateStyle do servidor
+            cur.execute("SET LOCAL DateStyle TO 'ISO, YMD'")
+            duck.execute("BEGIN TRANSACTION")
+            try:
+                duck.execute(f"CREATE TABLE IF NOT EXISTS {self.STATE_TABLE} "
+                             "(tabela VARCHAR, arquivo_origem_id BIGINT, versao VARCHAR, lote INTEGER)")
+                duck.execute(f"CREATE TABLE IF NOT EXISTS {self.TABLES_TABLE} (tabela VARCHAR PRIMARY KEY, oid BIGINT)")
+                mirrored = dict(duck.execute(f"SELECT tabela, oid FROM {self.TABLES_TABLE}").fetchall())
+                for table_name in [*self.dims, *self.facts]:
+                    oid = pg_tables[table_name][0] if table_name in pg_tables else None
+                    if mirrored.get(table_name) == oid: continue
+                    if table_name in mirrored:
+                        logging.warning(f"♻️ {table_name} foi recriada ou apagada no Postgres; refazendo o espelho")
+                    duck.execute(f"DROP TABLE IF EXISTS {table_name}")
+                    duck.execute(f"DELETE FROM {self.STATE_TABLE} WHERE tabela = ?", [table_name])
+                    duck.execute(f"DELETE FROM {self.TABLES_TABLE} WHERE tabela = ?", [table_name])
+                    if oid is not None:
+                        duck.execute(f"INSERT INTO {self.TABLES_TABLE} VALUES (?, ?)", [table_name, oid])
+
+                for table_name, id_col in self.dims.items():
+                    if table_name not in pg_tables: continue
+                    columns = pg_tables[table_name][1]
+                    self._ensure_table(duck, table_name, columns)
+                    copied[table_name] = self._sync_dimension(conn, cur, duck, table_name, id_col, columns)
+                for table_name in self.facts:
+                    if table_name not in pg_tables: continue
+                    columns = pg_tables[table_name][1]
+                    self._ensure_table(duck, table_name, columns)
+                    copied[table_name] = self._sync_fact(conn, cur, duck, table_name, columns)
+                self._sync_views(duck)
+                duck.execute("COMMIT")
+            except Exception:
+                duck.execute("ROLLBACK")
+                raise
+            finally:
+                cur.close()
+                conn.rollback()
+            # Tudo no arquivo principal: a cópia é publicada sem WAL
+            duck.execute("CHECKPOINT")
+        return copied
+
+    def export_parquet(self, directory):
+        """Exporta o espelho como um conjunto Parquet (um arquivo por tabela)."""
+        import duckdb
+
+        with self._lock, duckdb.connect(self.path, read_only=True) as duck:
+            duck.execute(f"EXPORT DATABASE '{directory}' (FORMAT parquet)")
+
+# Processos que transformam lotes à frente do carregador (configs com "pipelined")
+TRANSFORM_WORKERS = max(1, (os.cpu_count() or 2) - 1)
+
+# Tentativas de um lote cuja transação foi escolhida como vítima de deadlock
+UOW_RETRIES = 3
+
 class ETLEngine:
-    def __init__(self):
-        self.db = SGBDLoader(DATABASE_URL)
+    def __init__(self, transform_workers=TRANSFORM_WORKERS, pool_options=None):
+        self.db = SGBDLoader(DATABASE_URL, pool_options=pool_options)
+        self.views = QueryViews(self.db)
+        # Espelho DuckDB opcional (DuckDBMirror), sincronizado ao fim de cada arquivo
+        self.mirror = None
+        # Incrementada ao fim de cada run(): invalida os caches de consulta da API
+        self.data_version = DataVersion()
         self.stats = Counter()
+        self._stats_lock = threading.Lock()
+        # Fatos alteradas desde o último refresh das views de consulta
+        self._changed_facts = set()
+        self.transform_workers = transform_workers
+        self._transform_pool = None
+        self._pool_lock = threading.Lock()
+
+    def _count(self, table_name, n):
+        with self._stats_lock:
+            self.stats[table_name] += n
+
+    def refresh_views(self):
+        """Atualiza as views de consulta das fatos carregadas (ou substituídas) desde a última chamada."""
+        with self._stats_lock:
+            facts, self._changed_facts = self._changed_facts, set()
+        if facts: self.views.refresh(facts)
+
+    def sync_mirror(self):
+        """Sincroniza o espelho DuckDB. Um erro é registrado sem interromper a carga;
+        devolve True só se o espelho ficou em dia (e a versão dos dados pode subir)."""
+        try:
+            self.mirror.sync()
+            return True
+        except Exception as e:
+            logging.error(f"❌ Erro ao sincronizar o espelho DuckDB: {e}")
+            return False
 
-    def run(self, config: dict):
+    def close(self):
+        if self._transform_pool is not None:
+            self._transform_pool.shutdown(cancel_futures=True)
+            self._transform_pool = None
+
+    def run(self, config: dict, reader=None):
+        """Executa o pipeline. `reader` (opcional) é um iterável de DataFrames já
+        normalizados, como o devolvido por DataFetcher.open_stream; sem ele, lê
+        config['source']['path']."""
         print(f"\n🚀 Pipeline: {config['name']}")
         
         b_size = config.get('batch_size') 
         
-        # 1. LEITURA EM LOTES
-        reader = pd.read_csv(
-            config['source']['path'], 
-            sep=';', 
-            dtype=str, 
-            chunksize=b_size
-        )
+        used_cols = set(extract_required_columns(config))
+
+        # Recurso de origem: as linhas da fato levam seu id, cada lote grava um
+        # checkpoint e uma carga interrompida retoma do primeiro lote não confirmado.
+        # Uma versão anterior do mesmo arquivo é apagada antes da nova carga.
+        source_url = config['source'].get('url')
+        source_id = source_key(source_url) if source_url and "fact" in config else None
+        version = config['source'].get('version') or ""
+        done_rows = 0
+        if source_id is not None:
+            done_rows = self.db.prepare_source(config["fact"]["target_table"], source_id, version,
+                                               replace=config['source'].get('replace', False),
+                                               restart=config['source'].get('restart', False))
+            if done_rows:
+                logging.info(f"↩️ Retomando {config['name']} após {done_rows} linhas já carregadas")
+
+        # 1. LEITURA EM LOTES (apenas as colunas que a config usa)
+        if reader is None and config['source']['path'].endswith('.parquet'):
+            reader = StagingArea.read_batches(config['source']['path'], columns=used_cols, batch_size=b_size)
+        elif reader is None:
+            read_opts = dict(sep=';', dtype=str, usecols=lambda c: c in used_cols)
+            if b_size:
+                reader = pd.read_csv(config['source']['path'], chunksize=b_size, **read_opts)
+            else:
+                reader = [pd.read_csv(config['source']['path'], **read_opts)]
+        else:
+            b_size = b_size or STREAM_CHUNK_ROWS
 
-        if b_size is None:
-            reader = [pd.read_csv(config['source']['path'], sep=';', dtype=str)]
+        batches = self._pending_batches(config, reader, done_rows)
 
-        for i, df_raw in enumerate(reader):
+        # 2. TRANSFORMAÇÃO (em processos à frente da carga, se "pipelined")
+        if config.get("pipelined") and self.transform_workers > 1:
+            prepared_batches = self._transform_pipelined(config, batches)
+        else:
+            prepared_batches = ((i, rows_seen, self.transform_batch(config, df_raw)) for i, rows_seen, df_raw in batches)
+
+        # 3-4. CARGA (dimensões + fato), sempre em ordem
+        for i, rows_seen, prepared in prepared_batches:
             if b_size:
-                logging.info(f"📦 Processando lote {i+1} de {config['name']}...")
-
-            # --- LÓGICA DE SWAP (Colunas trocadas no CSV) ---
-            swaps = [('cnpj_instituicao', 'nome_instituicao'), ('cnpj_fornecedor', 'fornecedor'), ('cnpj_fabricante', 'fabricante')]
-            for c_cnpj, c_nome in swaps:
-                if c_cnpj in df_raw.columns and c_nome in df_raw.columns:
-                    sample = df_raw[c_cnpj].dropna().head(100)
-                    if not sample.empty and sample.str.contains('[A-Z]', na=False).any():
-                        df_raw[c_cnpj], df_raw[c_nome] = df_raw[c_nome].values, df_raw[c_cnpj].values
-
-            # --- LIMPEZA INICIAL ---
-            df_clean = Sanitizer.clean_generic(df_raw)
-            if "clean_numbers" in config:
-                for c in config["clean_numbers"]:
-                    if c in df_clean.columns:
-                        df_clean[c] = df_clean[c].astype(str).str.replace(r'[^0-9]', '', regex=True)
-
-            loaded_refs = {}
-
-            # --- 3. DIMENSÕES ---
-            for dim in config.get("dimensions", []):
-                t_name, id_col = dim["target_table"].lower(), dim["id_col"].lower()
-                db_keys = [k.lower() for k in dim["keys"]]
-                
-                # 3.1. Mapeamento e Garantia de Colunas (reindex aqui evita KeyError)
-                df_mapped = Sanitizer.apply_mapping(df_clean, dim["mapping"])
-                
-                # Garante que todas as keys da dimensão existam
-                all_cols = list(set(db_keys + list(df_mapped.columns)))
-                df_mapped = df_mapped.reindex(columns=all_cols, fill_value="")
-                
-                cols_to_keep_in_db = list(df_mapped.columns)
-
-                # 3.2. LOOKUPS (Join entre dimensões, ex: endereco_id na instituicao)
-                if "lookups" in dim:
-                    for ref_table, info in dim["lookups"].items():
-                        ref_key = ref_table.lower()
-                        if ref_key in loaded_refs:
-                            df_lkp_src = Sanitizer.apply_mapping(df_clean, dim.get("lookup_sources", {}))
-                            df_for_join = pd.concat([df_mapped, df_lkp_src], axis=1)
-                            
-                            # Remove colunas duplicadas após o concat
-                            df_for_join = df_for_join.loc[:, ~df_for_join.columns.duplicated()]
-                            
-                            ref_df = loaded_refs[ref_key]
-                            j_keys = [k.lower() for k in info["join_keys"]]
-                            t_fk = info.get("target_id_col", info.get("target_fk")).lower()
-                            
-                            # Vacina de Join: Garante que as chaves de busca existam
-                            df_for_join = df_for_join.reindex(columns=list(set(df_for_join.columns) | set(j_keys)), fill_value="")
-                            
-                            df_for_join = df_for_join.merge(ref_df[j_keys + [info["ref_pk"].lower()]], on=j_keys, how='left')
-                            df_for_join.rename(columns={info["ref_pk"].lower(): t_fk}, inplace=True)
-                            
-                            df_mapped = df_for_join
-                            cols_to_keep_in_db.append(t_fk)
-
-                # 3.3. PREPARAÇÃO E CARGA
-                # Mantemos as chaves vazias ("") para não perder registros
-                df_final_dim = df_mapped.drop_duplicates(subset=db_keys)
-                
-                # Seleciona apenas colunas válidas para o banco
-                final_cols = [c for c in list(set(cols_to_keep_in_db)) if c in df_final_dim.columns]
-                df_final_dim = df_final_dim[final_cols]
+                logging.info(f"📦 Carregando lote {i+1} de {config['name']}...")
+            checkpoint = None
+            if source_id is not None:
+                checkpoint = {"arquivo_origem_id": source_id, "versao": version, "lote": i + 1,
+                              "linha_final": rows_seen, "tabela": config["fact"]["target_table"].lower()}
+            self.load_batch(config, prepared, source_id, checkpoint)
 
-                # Sincroniza Schema e Dados
-                self.db.ensure_table(t_name, dim["mapping"], keys=dim["keys"], lookups=dim.get("lookups"), pk_col=id_col)
-                df_sync, count = self.db.sync_dimension_full(df_final_dim, t_name, db_keys, id_col)
-                self.stats[t_name] += count
-                loaded_refs[t_name] = df_sync
+            # Limpeza de memória
+            del prepared
+            gc.collect()
 
-            # --- 4. FATO ---
-            if "fact" in config:
-                fact = config["fact"]
-                df_fact = Sanitizer.apply_mapping(df_clean, fact["mapping"])
+        if "fact" in config:
+            with self._stats_lock:
+                self._changed_facts.add(config["fact"]["target_table"].lower())
+
+        # Com espelho, a versão só sobe quando ele tem os dados novos: senão a API
+        # guardaria no cache, como atuais, resultados lidos do espelho antigo
+        if self.mirror is None or self.sync_mirror():
+            self.data_version.bump()
+
+    @staticmethod
+    def _pending_batches(config, reader, done_rows):
+        """Numera os lotes e pula o que já foi confirmado em uma execução anterior."""
+        rows_seen = 0
+        for i, df_raw in enumerate(reader):
+            start, rows_seen = rows_seen, rows_seen + len(df_raw)
+            if rows_seen <= done_rows:
+                logging.info(f"⏭️ Lote {i+1} de {config['name']} já carregado")
+                continue
+            if start < done_rows:
+                df_raw = df_raw.iloc[done_rows - start:]
+            yield i, rows_seen, df_raw
+
+    def _get_transform_pool(self):
+        with self._pool_lock:
+            if self._transform_pool is None:
+                # spawn: o carregador roda em threads, e fork com threads vivas não é seguro
+                self._transform_pool = ProcessPoolExecutor(max_workers=self.transform_workers,
+                                                           mp_context=multiprocessing.get_context("spawn"))
+            return self._transform_pool
+
+    def _transform_pipelined(self, config, batches):
+        """Mantém até transform_workers + 1 lotes em transformação enquanto o
+        lote atual é carregado (fila limitada = contrapressão na leitura)."""
+        pool = self._get_transform_pool()
+        depth = self.transform_workers + 1
+        inflight = deque()
+        try:
+            for i, rows_seen, df_raw in batches:
+                inflight.append((i, rows_seen, pool.submit(ETLEngine.transform_batch, config, df_raw)))
+                if len(inflight) >= depth:
+                    i0, r0, fut = inflight.popleft()
+                    yield i0, r0, fut.result()
+            while inflight:
+                i0, r0, fut = inflight.popleft()
+                yield i0, r0, fut.result()
+        finally:
+            for _, _, fut in inflight:
+                fut.cancel()
+
+    @staticmethod
+    def transform_batch(config: dict, df_raw: pd.DataFrame) -> dict:
+        """Parte do lote que não depende do banco: limpeza e mapeamentos.
+        Roda no processo principal ou em um worker do pool."""
+        used_cols = set(extract_required_columns(config))
+
+        # Lotes do read_csv chegam com índice contínuo (ex: 500000..999999);
+        # os merges da carga devolvem RangeIndex, então alinhamos desde já.
+        df_raw = df_raw.reset_index(drop=True)
+
+        # --- LÓGICA DE SWAP (Colunas trocadas no CSV) ---
+        swaps = [('cnpj_instituicao', 'nome_instituicao'), ('cnpj_fornecedor', 'fornecedor'), ('cnpj_fabricante', 'fabricante')]
+        for c_cnpj, c_nome in swaps:
+            if c_cnpj in df_raw.columns and c_nome in df_raw.columns:
+                sample = df_raw[c_cnpj].dropna().head(100)
+                if not sample.empty and sample.str.contains('[A-Z]', na=False).any():
+                    df_raw[c_cnpj], df_raw[c_nome] = df_raw[c_nome].values, df_raw[c_cnpj].values
+
+        # --- LIMPEZA INICIAL ---
+        df_clean = Sanitizer.clean_generic(df_raw, columns=used_cols)
+        if "clean_numbers" in config:
+            for c in config["clean_numbers"]:
+                if c in df_clean.columns:
+                    df_clean[c] = df_clean[c].astype(str).str.replace(r'[^0-9]', '', regex=True)
+
+        prepared = {"dims": [], "fact": None, "fact_keys": {}}
+
+        # --- DIMENSÕES: mapeamento ---
+        for dim in config.get("dimensions", []):
+            db_keys = [k.lower() for k in dim["keys"]]
+
+            # Mapeamento e Garantia de Colunas (reindex aqui evita KeyError)
+            df_mapped = Sanitizer.apply_mapping(df_clean, dim["mapping"])
+
+            # Garante que todas as keys da dimensão existam
+            all_cols = list(set(db_keys + list(df_mapped.columns)))
+            df_mapped = df_mapped.reindex(columns=all_cols, fill_value="")
+
+            # Hashes da chave da própria dimensão e das chaves de cada lookup (ex: endereco)
+            lookup_hashes = {}
+            if "lookups" in dim:
+                df_lkp_src = Sanitizer.apply_mapping(df_clean, dim.get("lookup_sources", {}))
+                df_for_join = pd.concat([df_mapped, df_lkp_src], axis=1)
+                df_for_join = df_for_join.loc[:, ~df_for_join.columns.duplicated()]
+                for ref_table, info in dim["lookups"].items():
+                    lookup_hashes[ref_table.lower()] = key_hash(df_for_join, info["join_keys"])
+            prepared["dims"].append({"mapped": df_mapped, "hashes": key_hash(df_mapped, db_keys),
+                                     "lookup_hashes": lookup_hashes})
+
+        # --- FATO: mapeamento, chaves de lookup e preço ---
+        if "fact" in config:
+            fact = config["fact"]
+            df_fact = Sanitizer.apply_mapping(df_clean, fact["mapping"])
+
+            for d_name, info in fact.get("lookups", {}).items():
+                df_keys = Sanitizer.apply_mapping(df_clean, info.get("join_keys", {}))
+                prepared["fact_keys"][d_name.lower()] = key_hash(df_keys, info.get("join_keys", {}).values())
+
+            # Lógica de Preço (Cálculo automático se faltar o total)
+            if 'preco_unitario' in df_fact.columns and 'quantidade_de_itens' in df_fact.columns:
+                if 'preco_total' not in df_fact.columns: df_fact['preco_total'] = 0.0
+                mask = (df_fact['preco_total'].isna()) | (df_fact['preco_total'] == 0) | (df_fact['preco_total'] == "")
                 
-                # Lookups na Fato (Conecta todas as FKs)
-                for d_name, info in fact.get("lookups", {}).items():
-                    d_key = d_name.lower()
-                    if d_key in loaded_refs:
-                        d_map = loaded_refs[d_key]
-                        t_fk = info["target_id_col"].lower()
-                        j_map = info.get("join_keys", {})
-                        
-                        # j_dst_cols são os nomes das colunas na Dimensão de destino
-                        j_dst_cols = [k.lower() for k in j_map.values()]
-                        
-                        df_temp_keys = Sanitizer.apply_mapping(df_clean, j_map)
-                        df_fact_with_keys = pd.concat([df_fact, df_temp_keys], axis=1)
-                        
-                        # Vacina na Fato: Garante colunas de join (ex: catmat ou logradouro vazio)
-                        df_fact_with_keys = df_fact_with_keys.reindex(columns=list(set(df_fact_with_keys.columns) | set(j_dst_cols)), fill_value="")
-                        
-                        df_fact_with_keys = df_fact_with_keys.merge(d_map[j_dst_cols + [info["pk_dim"].lower()]], on=j_dst_cols, how='left')
-                        df_fact[t_fk] = df_fact_with_keys[info["pk_dim"].lower()]
-
-                # Lógica de Preço (Cálculo automático se faltar o total)
-                if 'preco_unitario' in df_fact.columns and 'quantidade_de_itens' in df_fact.columns:
-                    if 'preco_total' not in df_fact.columns: df_fact['preco_total'] = 0.0
-                    mask = (df_fact['preco_total'].isna()) | (df_fact['preco_total'] == 0) | (df_fact['preco_total'] == "")
-                    
-                    # Converte para float apenas para o cálculo
-                    q = pd.to_numeric(df_fact.loc[mask, 'quantidade_de_itens'], errors='coerce').fillna(0)
-                    p = pd.to_numeric(df_fact.loc[mask, 'preco_unitario'], errors='coerce').fillna(0)
-                    df_fact.loc[mask, 'preco_total'] = q * p
-
-                # Carga Final da Fato
-                self.db.ensure_table(fact["target_table"], fact["mapping"], lookups=fact.get("lookups"), pk_col=fact.get("id_col"))
-                count_fact = self.db.load_fact(df_fact, fact["target_table"])
-                self.stats[fact["target_table"]] += count_fact
+                # Converte para float apenas para o cálculo
+                q = pd.to_numeric(df_fact.loc[mask, 'quantidade_de_itens'], errors='coerce').fillna(0)
+                p = pd.to_numeric(df_fact.loc[mask, 'preco_unitario'], errors='coerce').fillna(0)
+                df_fact.loc[mask, 'preco_total'] = q * p
+
+            prepared["fact"] = df_fact
+
+        return prepared
+
+    def load_batch(self, config: dict, prepared: dict, source_id=None, checkpoint=None):
+        """Parte do lote que depende do banco: sincroniza dimensões, resolve FKs e carrega a fato.
+
+        Dimensões, fato, cubos e checkpoint do lote vão em uma única unidade de
+        trabalho (uma conexão, um commit). O DDL (tabelas, partições, cubos) roda
+        antes, fora dela, para que a transação do lote só espere por linhas.
+        """
+        self.prepare_batch_schema(config, prepared)
+
+        for attempt in range(1, UOW_RETRIES + 1):
+            try:
+                with self.db.unit_of_work() as uow:
+                    counts = self._load_batch(config, prepared, uow, source_id, checkpoint)
+                break
+            except pg_errors.DeadlockDetected:
+                # O servidor desfez a transação inteira: o lote é refeito do zero
+                self.db.metrics.count("deadlocks")
+                if attempt == UOW_RETRIES: raise
+                logging.warning(f"🔁 Deadlock no lote de {config['name']}. Tentativa {attempt + 1}/{UOW_RETRIES}.")
+
+        for t_name, n in counts.items(): self._count(t_name, n)
+
+    def prepare_batch_schema(self, config: dict, prepared: dict):
+        """DDL que o lote precisa, cada parte em sua própria transação."""
+        for dim in config.get("dimensions", []):
+            self.db.ensure_table(dim["target_table"].lower(), dim["mapping"], keys=dim["keys"],
+                                 lookups=dim.get("lookups"), pk_col=dim["id_col"].lower())
+        if "fact" in config:
+            fact = config["fact"]
+            df_fact = prepared["fact"]
+            self.db.ensure_table(fact["target_table"], fact["mapping"], lookups=fact.get("lookups"), pk_col=fact.get("id_col"),
+                                 extra_columns={"arquivo_origem_id": "BIGINT"}, partition=fact.get("partition"))
+            if fact.get("partition") and fact["partition"]["column"] in df_fact.columns:
+                self.db.ensure_partitions(fact["target_table"], fact["partition"], df_fact[fact["partition"]["column"]])
+            self.db.ensure_checkpoint_table()
+            self.db.rollups.ensure(fact["target_table"])
+
+    def _load_batch(self, config: dict, prepared: dict, uow, source_id=None, checkpoint=None):
+        counts = Counter()
+        # Dimensões já sincronizadas neste lote: tabela -> chaves do slot no dim_cache
+        loaded_refs = {}
+
+        # --- 3. DIMENSÕES ---
+        for dim, dim_batch in zip(config.get("dimensions", []), prepared["dims"]):
+            t_name, id_col = dim["target_table"].lower(), dim["id_col"].lower()
+            db_keys = [k.lower() for k in dim["keys"]]
+            df_mapped = dim_batch["mapped"]
             
-            # Limpeza de memória
-            del df_raw, df_clean
-            gc.collect()
+            cols_to_keep_in_db = list(df_mapped.columns)
+
+            # 3.2. LOOKUPS (Join entre dimensões, ex: endereco_id na instituicao)
+            for ref_table, info in dim.get("lookups", {}).items():
+                ref_key = ref_table.lower()
+                if ref_key in loaded_refs:
+                    t_fk = info.get("target_id_col", info.get("target_fk")).lower()
+                    df_mapped[t_fk] = uow.lookup(ref_key, loaded_refs[ref_key], dim_batch["lookup_hashes"][ref_key])
+                    cols_to_keep_in_db.append(t_fk)
+
+            # 3.3. PREPARAÇÃO E CARGA
+            # Mantemos as chaves vazias ("") para não perder registros
+            first = ~pd.Series(dim_batch["hashes"]).duplicated().to_numpy()
+            df_final_dim = df_mapped[first]
+            
+            # Seleciona apenas colunas válidas para o banco
+            final_cols = [c for c in list(set(cols_to_keep_in_db)) if c in df_final_dim.columns]
+            df_final_dim = df_final_dim[final_cols]
+
+            counts[t_name] += self.db.sync_dimension_full(df_final_dim, t_name, db_keys, id_col,
+                                                          hashes=dim_batch["hashes"][first], uow=uow)
+            loaded_refs[t_name] = db_keys
+
+        # --- 4. FATO ---
+        if "fact" in config:
+            fact = config["fact"]
+            df_fact = prepared["fact"]
+            
+            # Lookups na Fato (Conecta todas as FKs): busca do hash da chave no dim_cache
+            for d_name, info in fact.get("lookups", {}).items():
+                d_key = d_name.lower()
+                if d_key in loaded_refs:
+                    t_fk = info["target_id_col"].lower()
+                    df_fact[t_fk] = uow.lookup(d_key, loaded_refs[d_key], prepared["fact_keys"][d_key])
+
+            if source_id is not None:
+                df_fact['arquivo_origem_id'] = source_id
+
+            # Carga Final da Fato
+            counts[fact["target_table"]] += self.db.load_fact(df_fact, fact["target_table"],
+                                                              method=config.get("load_method", "multi"),
+                                                              checkpoint=checkpoint, uow=uow)
+        return counts
 
 # ==============================================================================
 # 5. MÓDULO WEB SCRAPER
 # ==============================================================================
+# Linhas por lote quando o arquivo é lido em streaming sem batch_size na config
+STREAM_CHUNK_ROWS = 200000
+# Tamanho dos blocos gravados em disco durante o download
+DOWNLOAD_CHUNK_BYTES = 1024 * 1024
+# Amostra usada para detectar separador/encoding sem carregar o arquivo todo
+SNIFF_BYTES = 1024 * 1024
+
+CSV_POSSIBILITIES = [(';', 'utf-8'), (',', 'utf-8'), (';', 'latin-1'), (',', 'latin-1'), (';', 'cp1252')]
+
+# Staging colunar: cópia Parquet de cada recurso baixado, mantida entre execuções
+LAKE_DIR = "lake"
+# Chave dos metadados do Parquet com a origem do recurso (url, sha256, colunas)
+STAGE_META_KEY = b"dados_datasus"
+
+class StageWriter:
+    """Grava um recurso no staging em lotes. O Parquet é escrito em `path + '.tmp'`
+    e só aparece no destino no commit(); um download interrompido não deixa
+    arquivo pela metade no lake."""
+    def __init__(self, path, meta):
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        self.meta = meta
+        self._writer = None
+        self._schema = None
+
+    def write(self, df: pd.DataFrame):
+        df = df.loc[:, ~df.columns.duplicated()]
+        if self._writer is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            # Tudo texto, como o read_csv(dtype=str): a tipagem fica com o ETL
+            self._schema = pa.schema([(c, pa.string()) for c in df.columns],
+                                     metadata={STAGE_META_KEY: json.dumps(self.meta).encode()})
+            self._writer = pq.ParquetWriter(self.tmp_path, self._schema, compression="zstd")
+        chunk = df.reindex(columns=self._schema.names).astype(object)
+        self._writer.write_table(pa.Table.from_pandas(chunk, schema=self._schema, preserve_index=False))
+
+    def commit(self):
+        if self._writer is None: return False
+        self._writer.close()
+        self._writer = None
+        os.replace(self.tmp_path, self.path)
+        return True
+
+    def abort(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if os.path.exists(self.tmp_path): os.remove(self.tmp_path)
+
+class StagingArea:
+    """Staging Parquet particionado por dataset e ano:
+
+        lake/dataset=bps/ano=2021/<arquivo>.parquet
+
+    Guarda só as colunas que a config usa (extract_required_columns, nomes
+    normalizados) e, nos metadados, a URL, o sha256 e essa lista de colunas
+    ("colunas"; ausente nos arquivos com todas as colunas). Uma recarga depois
+    de mudar mappings ou o schema não precisa baixar nada de novo enquanto as
+    colunas exigidas continuarem no arquivo (ver reload_from_stage). Se a
+    config passar a exigir outra coluna da fonte, o recurso é baixado de novo:
+    o staging guarda o mesmo recorte do parse (usecols), e esse download é o
+    preço de não ler as colunas que nenhuma config usa.
+    """
+    def __init__(self, root=LAKE_DIR):
+        self.root = root
+
+    def path_for(self, dataset, url):
+        file_name = os.path.basename(url).split('?')[0]
+        # O ano vem de preferência do nome do arquivo (o caminho pode ter outros números)
+        year = get_year_from_url(file_name) or get_year_from_url(url) or "desconhecido"
+        name = normalize_column_name(file_name.rsplit('.', 1)[0]) or "recurso"
+        # Sufixo do source_key: URLs diferentes com o mesmo nome de arquivo não colidem
+        return os.path.join(self.root, f"dataset={dataset}", f"ano={year}", f"{name}_{source_key(url) & 0xffffffff:08x}.parquet")
+
+    @staticmethod
+    def meta(path):
+        metadata = pq.read_schema(path).metadata or {}
+        return json.loads(metadata.get(STAGE_META_KEY, b"{}"))
+
+    def entries(self, dataset):
+        """(caminho, metadados) dos recursos de um dataset, em ordem de ano."""
+        base = os.path.join(self.root, f"dataset={dataset}")
+        if not os.path.isdir(base): return []
+        paths = []
+        for part in sorted(os.listdir(base)):
+            part_dir = os.path.join(base, part)
+            paths += [os.path.join(part_dir, f) for f in sorted(os.listdir(part_dir)) if f.endswith(".parquet")]
+        return [(path, self.meta(path)) for path in paths]
+
+    @staticmethod
+    def covers(meta, columns):
+        """O arquivo staged tem todas as `columns` exigidas? (literais LIT_ não vêm do CSV)"""
+        staged = meta.get("colunas")
+        if staged is None: return True
+        return {c for c in columns if not c.startswith("LIT_")} <= set(staged)
+
+    def is_stale(self, path, columns):
+        """O Parquet staged do recurso existe mas não tem todas as colunas da config?"""
+        return os.path.exists(path) and not self.covers(self.meta(path), columns)
+
+    @staticmethod
+    def read_batches(path, columns=None, batch_size=None):
+        """Lê o Parquet projetando apenas `columns`, em lotes de `batch_size` linhas
+        (None = um único lote). Colunas exigidas que o arquivo não tem chegam como ""
+        (exceto literais lit_), como no download."""
+        pf = pq.ParquetFile(path)
+        present = [c for c in pf.schema_arrow.names if columns is None or c in columns]
+        absent = [c for c in (columns or []) if c not in present and not c.startswith("lit_")]
+        batches = pf.iter_batches(batch_size=batch_size, columns=present) if batch_size else [pf.read(columns=present)]
+        for batch in batches:
+            df = batch.to_pandas()
+            for col in absent:
+                df[col] = ""
+            yield df
+
 def import_unicodedata(s):
     return unicodedata.normalize('NFKD', str(s))
 
+def normalize_column_name(col_name):
+    return re.sub(r'[^a-z0-9]+', '_', "".join([c for c in import_unicodedata(col_name) if not unicodedata.combining(c)]).lower()).strip('_')
+
 class DataFetcher:
-    def __init__(self, output_temp_file="temp_stage.csv"):
+    def __init__(self, output_temp_file="temp_stage.parquet", download_file="temp_download.bin"):
+        # Destino Parquet do recurso no staging (mantido após a carga)
         self.output_temp_file = output_temp_file
+        self.download_file = download_file
+        # Validadores HTTP + sha256 do último download (ver ProcessTracker)
+        self.resource_meta = {}
+
+    @staticmethod
+    def _response_meta(resp):
+        return {
+            "etag": resp.headers.get("ETag"),
+            "last_modified": resp.headers.get("Last-Modified"),
+            "content_length": resp.headers.get("Content-Length"),
+            "not_modified": resp.status_code == 304,
+        }
+
+    def cleanup(self):
+        """Remove o download bruto e staging incompleto; o Parquet final fica no lake."""
+        for path in (self.output_temp_file + ".tmp", self.download_file):
+            if os.path.exists(path): os.remove(path)
+
+    def stage_writer(self, url, required_columns=None):
+        meta = {"url": url, "sha256": self.resource_meta.get("sha256")}
+        if required_columns:
+            meta["colunas"] = sorted(required_columns)
+        return StageWriter(self.output_temp_file, meta)
 
     def fetch_page(self, url):
         try:
@@ -651,11 +2393,18 @@ class DataFetcher:
             logging.error(f"❌ Erro ao acessar {url}: {e}")
             return None
 
-    def read_and_clean_csv(self, file_bytes):
+    @staticmethod
+    def usecols_for(required_columns):
+        """Filtro de colunas para o read_csv: compara o nome já normalizado do
+        cabeçalho com as colunas exigidas pela config (None = todas)."""
+        if not required_columns: return None
+        wanted = set(required_columns)
+        return lambda col_name: normalize_column_name(col_name) in wanted
+
+    def read_and_clean_csv(self, file_bytes, required_columns=None):
+        # Sem required_columns o CSV é lido inteiro
         # Tenta detectar separador e encoding
-        possibilities = [(';', 'utf-8'), (',', 'utf-8'), (';', 'latin-1'), (',', 'latin-1'), (';', 'cp1252')]
-        
-        for sep, enc in possibilities:
+        for sep, enc in CSV_POSSIBILITIES:
             try:
                 file_bytes.seek(0)
                 # Lê apenas header
@@ -663,17 +2412,25 @@ class DataFetcher:
                 if len(df_test.columns) > 1:
                     # Se deu certo, lê tudo
                     file_bytes.seek(0)
-                    df = pd.read_csv(file_bytes, sep=sep, encoding=enc, dtype=str, on_bad_lines='skip')
+                    df = pd.read_csv(file_bytes, sep=sep, encoding=enc, dtype=str, on_bad_lines='skip',
+                                     usecols=self.usecols_for(required_columns))
                     logging.info(f"✅ CSV detectado: sep='{sep}', enc='{enc}', linhas={len(df)}")
                     return df
             except:
                 continue
         return None
 
-    def download_and_save(self, url, required_columns=None):
+    def download_and_save(self, url, required_columns=None, headers=None):
+        """Baixa o recurso e grava no Parquet de staging só `required_columns`
+        (None = todas), já filtradas na leitura do CSV."""
         logging.info(f"⬇️ Baixando: {url}")
         try:
-            resp = requests.get(url, timeout=180)
+            resp = requests.get(url, headers=headers, timeout=180)
+            self.resource_meta = self._response_meta(resp)
+            if resp.status_code == 304:
+                return False
+            resp.raise_for_status()
+            self.resource_meta["sha256"] = hashlib.sha256(resp.content).hexdigest()
             file_obj = io.BytesIO(resp.content)
             
             df = None
@@ -684,25 +2441,22 @@ class DataFetcher:
                         with zf.open(csvs[0]) as zf_csv:
                             # Carrega em memória bytes do arquivo dentro do zip
                             csv_bytes = io.BytesIO(zf_csv.read())
-                            df = self.read_and_clean_csv(csv_bytes)
+                            df = self.read_and_clean_csv(csv_bytes, required_columns)
             else:
-                df = self.read_and_clean_csv(file_obj)
+                df = self.read_and_clean_csv(file_obj, required_columns)
 
             if df is not None and not df.empty:
                 # Normaliza colunas
-                df.columns = [
-                    re.sub(r'[^a-z0-9]+', '_', "".join([c for c in import_unicodedata(col_name) if not unicodedata.combining(c)]).lower()).strip('_')
-                    for col_name in df.columns
-                ]
-                
-                # Harmoniza colunas faltantes
-                if required_columns:
-                    for req in required_columns:
-                        if req not in df.columns and not req.startswith("lit_"):
-                            df[req] = ""
-
-                # Salva em disco temporariamente para o Pandas reler limpo no Orchestrator
-                df.to_csv(self.output_temp_file, index=False, sep=";", encoding="utf-8")
+                df.columns = [normalize_column_name(col_name) for col_name in df.columns]
+
+                # Staging colunar; colunas faltantes são completadas na leitura (StagingArea.read_batches)
+                writer = self.stage_writer(url, required_columns)
+                try:
+                    writer.write(df)
+                    writer.commit()
+                except Exception:
+                    writer.abort()
+                    raise
                 return True
             else:
                 logging.warning("⚠️ Falha ao ler DataFrame ou arquivo vazio.")
@@ -712,26 +2466,254 @@ class DataFetcher:
             logging.error(f"❌ Erro no download/processamento: {e}")
             return False
 
+    # --- MODO STREAMING ---
+    def download_to_disk(self, url, headers=None):
+        """Grava a resposta HTTP em disco em blocos, sem manter o corpo em memória.
+        Devolve None se o servidor responder 304 (não modificado)."""
+        with requests.get(url, headers=headers, stream=True, timeout=180) as resp:
+            self.resource_meta = self._response_meta(resp)
+            if resp.status_code == 304:
+                return None
+            resp.raise_for_status()
+            digest = hashlib.sha256()
+            with open(self.download_file, "wb") as f:
+                for block in resp.iter_content(chunk_size=DOWNLOAD_CHUNK_BYTES):
+                    digest.update(block)
+                    f.write(block)
+        self.resource_meta["sha256"] = digest.hexdigest()
+        return self.download_file
+
+    @contextmanager
+    def _open_source(self, path, url):
+        """Abre o CSV baixado; se for zip, o membro é descompactado sob demanda.
+        Entrega None se o zip não tem CSV; na saída fecham o membro e o zip."""
+        if not url.lower().endswith('.zip'):
+            with open(path, "rb") as raw:
+                yield raw
+            return
+        with zipfile.ZipFile(path) as zf:
+            csvs = [f for f in zf.namelist() if f.lower().endswith('.csv')]
+            if not csvs:
+                yield None
+                return
+            with zf.open(csvs[0]) as raw:
+                yield raw
+
+    def sniff_csv(self, raw):
+        """Detecta separador e encoding a partir do começo do arquivo."""
+        sample = raw.read(SNIFF_BYTES)
+        raw.seek(0)
+        # Descarta a última linha (possivelmente cortada no meio de um caractere)
+        sample = sample[:sample.rfind(b"\n") + 1] or sample
+
+        for sep, enc in CSV_POSSIBILITIES:
+            try:
+                sample.decode(enc)
+                df_test = pd.read_csv(io.BytesIO(sample), sep=sep, encoding=enc, dtype=str, on_bad_lines='skip', nrows=10)
+                if len(df_test.columns) > 1:
+                    return sep, enc
+            except:
+                continue
+        return None
+
+    def open_stream(self, url, required_columns=None, chunksize=STREAM_CHUNK_ROWS, headers=None):
+        """Baixa o arquivo para disco e devolve um leitor em lotes já normalizado
+        (apenas `required_columns`), ou None. Conforme os lotes são consumidos,
+        eles também são gravados no Parquet de staging."""
+        logging.info(f"⬇️ Baixando (streaming): {url}")
+        try:
+            path = self.download_to_disk(url, headers=headers)
+            if path is None:
+                return None
+            with self._open_source(path, url) as raw:
+                if raw is None:
+                    logging.warning("⚠️ Nenhum CSV encontrado no arquivo.")
+                    self.cleanup()
+                    return None
+                fmt = self.sniff_csv(raw)
+            if fmt is None:
+                logging.warning("⚠️ Falha ao detectar o formato do CSV.")
+                self.cleanup()
+                return None
+            sep, enc = fmt
+            logging.info(f"✅ CSV detectado: sep='{sep}', enc='{enc}' (streaming)")
+        except Exception as e:
+            logging.error(f"❌ Erro no download/processamento: {e}")
+            self.cleanup()
+            return None
+
+        return self._iter_chunks(path, url, sep, enc, required_columns, chunksize)
+
+    def _iter_chunks(self, path, url, sep, enc, required_columns, chunksize):
+        writer = self.stage_writer(url, required_columns)
+        completed = False
+        try:
+            # O arquivo só é reaberto quando o ETL começa a consumir os lotes
+            with self._open_source(path, url) as raw:
+                # O filtro de colunas é aplicado já no parse; o staging guarda o mesmo recorte
+                reader = pd.read_csv(raw, sep=sep, encoding=enc, dtype=str, on_bad_lines='skip', chunksize=chunksize,
+                                     usecols=self.usecols_for(required_columns))
+                columns = None
+                for chunk in reader:
+                    if columns is None:
+                        columns = [normalize_column_name(c) for c in chunk.columns]
+                    chunk.columns = columns
+                    writer.write(chunk)
+                    if required_columns:
+                        for req in required_columns:
+                            if req not in chunk.columns and not req.startswith("lit_"):
+                                chunk[req] = ""
+                    yield chunk
+            completed = True
+        finally:
+            if completed: writer.commit()
+            else: writer.abort()
+            if os.path.exists(self.download_file): os.remove(self.download_file)
+
+# ==============================================================================
+# 5.1 ESCALONADOR DE INGESTÃO PARALELA
+# ==============================================================================
+
+# Downloads simultâneos (I/O) e cargas simultâneas (CPU/banco)
+FETCH_WORKERS = 4
+LOAD_WORKERS = 3
+STAGE_DIR = "stage"
+
+class IngestScheduler:
+    """Sobrepõe downloads e cargas de vários arquivos.
+
+    Cada dataset ganha `max_parallel_files` filas (lanes) que carregam seus
+    arquivos em ordem cronológica; enquanto um arquivo é carregado, o próximo
+    da mesma fila já está sendo baixado. Cada recurso é gravado no seu Parquet
+    do StagingArea (mantido); o download bruto fica em `stage_dir` só até o
+    fim da carga. A consistência dos ids de dimensão fica a cargo dos locks por
+    tabela do SGBDLoader.
+    """
+    def __init__(self, orchestrator, tracker, fetch_workers=FETCH_WORKERS, load_workers=LOAD_WORKERS, stage_dir=STAGE_DIR,
+                 staging=None):
+        self.orchestrator = orchestrator
+        self.tracker = tracker
+        self.staging = staging or StagingArea()
+        self.fetch_workers = fetch_workers
+        self.stage_dir = stage_dir
+        self._load_slots = threading.BoundedSemaphore(load_workers)
+        self._datasets = []
+
+    def add_dataset(self, key, config, urls):
+        jobs = queue.Queue()
+        for n, url in enumerate(urls):
+            jobs.put((n, url))
+        self._datasets.append((key, config, jobs))
+
+    def run(self):
+        os.makedirs(self.stage_dir, exist_ok=True)
+        lanes = [(key, config, jobs) for key, config, jobs in self._datasets
+                 for _ in range(max(1, config.get("max_parallel_files", 1)))]
+        if not lanes: return
+
+        with ThreadPoolExecutor(max_workers=self.fetch_workers, thread_name_prefix="fetch") as fetch_pool, \
+             ThreadPoolExecutor(max_workers=len(lanes), thread_name_prefix="load") as lane_pool:
+            futures = [lane_pool.submit(self._lane, fetch_pool, *lane) for lane in lanes]
+            for fut in futures:
+                fut.result()
+
+    def _next_download(self, fetch_pool, key, config, jobs):
+        try:
+            n, url = jobs.get_nowait()
+        except queue.Empty:
+            return None
+        fetcher = DataFetcher(
+            output_temp_file=self.staging.path_for(key, url),
+            download_file=os.path.join(self.stage_dir, f"{key}_{n:04d}.bin"),
+        )
+        return url, fetcher, fetch_pool.submit(self._download, fetcher, url, config)
+
+    def _download(self, fetcher, url, config):
+        """(staged, restart) do recurso, ou None se ele não mudou. `restart`: o
+        staging estava defasado e a carga refaz o recurso mesmo na mesma versão."""
+        req_cols = extract_required_columns(config)
+        # Requisição condicional para recursos já carregados. Se o staging não tem
+        # mais todas as colunas que a config exige, o recurso é baixado e recarregado.
+        # A marca no tracker vem antes de regravar o staging: se a recarga falhar,
+        # o próximo run ainda sabe que ela está pendente
+        stale = self.staging.is_stale(fetcher.output_temp_file, req_cols) or self.tracker.needs_reload(url)
+        if stale: self.tracker.mark_reload(url)
+        headers = None if stale else self.tracker.conditional_headers(url)
+        if config['source'].get('streaming'):
+            # Download em disco + leitura em lotes direto para o ETL (o Parquet é gravado durante a leitura)
+            staged = fetcher.open_stream(url, required_columns=req_cols,
+                                         chunksize=config.get('batch_size') or STREAM_CHUNK_ROWS, headers=headers)
+        else:
+            staged = fetcher.output_temp_file if fetcher.download_and_save(url, required_columns=req_cols, headers=headers) else None
+
+        if not stale and self.tracker.is_unchanged(url, fetcher.resource_meta):
+            print(f"⏩ Pulando (sem alterações): {os.path.basename(url)}")
+            fetcher.cleanup()
+            self.tracker.mark_processed(url, fetcher.resource_meta)
+            return None
+        return staged, stale
+
+    def _lane(self, fetch_pool, key, config, jobs):
+        pending = self._next_download(fetch_pool, key, config, jobs)
+        while pending:
+            url, fetcher, fut = pending
+            # Já dispara o download do próximo enquanto este é carregado
+            pending = self._next_download(fetch_pool, key, config, jobs)
+
+            downloaded = fut.result()
+            if downloaded is None:
+                continue
+            with self._load_slots:
+                self._load(config, url, fetcher, *downloaded)
+            gc.collect()
+
+    def _load(self, config, url, fetcher, staged, restart=False):
+        # Cópia rasa: jobs paralelos do mesmo dataset não compartilham o source.path
+        job_config = {**config, "source": {**config["source"], "url": url,
+                                           "version": fetcher.resource_meta.get("sha256")}}
+        # Arquivo já carregado antes e que mudou: a versão antiga sai da fato
+        job_config['source']['replace'] = self.tracker.is_processed(url)
+        # Recarga por coluna nova: o arquivo de origem pode ser o mesmo (mesmo sha256),
+        # então os checkpoints dessa versão não valem e tudo é recarregado
+        job_config['source']['restart'] = restart
+        try:
+            if isinstance(staged, str):
+                job_config['source']['path'] = staged
+                self.orchestrator.run(job_config)
+            else:
+                self.orchestrator.run(job_config, reader=staged)
+            self.tracker.mark_processed(url, fetcher.resource_meta)
+        except Exception as e:
+            logging.error(f"🔥 Erro no ETL ({os.path.basename(url)}): {e}")
+        finally:
+            if not isinstance(staged, str):
+                staged.close()
+            fetcher.cleanup()
+
 # ==============================================================================
 # 6. MAIN
 # ==============================================================================
 
 def extract_required_columns(config):
-    cols = set()
+    cols = set(config.get("clean_numbers", []))
     if "fact" in config:
         for k in config["fact"]["mapping"].keys(): cols.add(k)
+        for info in config["fact"].get("lookups", {}).values():
+            for k in info.get("join_keys", {}).keys(): cols.add(k)
     for dim in config.get("dimensions", []):
         for k in dim["mapping"].keys(): cols.add(k)
+        for k in dim.get("lookup_sources", {}).keys(): cols.add(k)
     return list(cols)
 
 def get_year_from_url(url):
     match = re.search(r'(\d{4})', url)
     return int(match.group(1)) if match else 0
 
-def reset_environment(engine, tracking_file="processed_files_pg.txt"):
+def reset_environment(engine, tracking_file="processed_files_pg.json"):
     """
     🚨 PERIGO: Apaga todas as tabelas do pipeline e o arquivo de controle.
-    Use apenas em ambiente de desenvolvimento/testes.
+    Use apenas em ambiente de desenvolvimento/testes. O staging Parquet (lake/)
+    é mantido e pode ser recarregado com reload_from_stage.
     """
     logging.warning("🧹 INICIANDO LIMPEZA TOTAL DO AMBIENTE...")
 
@@ -747,7 +2729,11 @@ def reset_environment(engine, tracking_file="processed_files_pg.txt"):
         "instituicao",
         "fornecedor",
         "fabricante",
-        "produto"
+        "produto",
+        # Controle
+        CHECKPOINT_TABLE,
+        # Cubos de agregação (schema de consulta)
+        *(f"{QUERY_SCHEMA}.{name}" for name in ROLLUPS)
     ]
 
     try:
@@ -758,77 +2744,123 @@ def reset_environment(engine, tracking_file="processed_files_pg.txt"):
     except Exception as e:
         logging.error(f"❌ Erro ao dropar tabelas: {e}")
 
-    # 2. Apagar Arquivo de Checkpoint (Tracker)
-    if os.path.exists(tracking_file):
+    # 2. Apagar Arquivo de Checkpoint (Tracker), inclusive o legado
+    files = [f for f in (tracking_file, LEGACY_TRACKING_FILE) if os.path.exists(f)]
+    for path in files:
         try:
-            os.remove(tracking_file)
-            logging.info(f"✅ Arquivo de controle '{tracking_file}' removido.")
+            os.remove(path)
+            logging.info(f"✅ Arquivo de controle '{path}' removido.")
         except OSError as e:
             logging.error(f"❌ Erro ao remover arquivo de controle: {e}")
-    else:
+    if not files:
         logging.info("ℹ️ Nenhum arquivo de controle encontrado para remover.")
         
     logging.info("✨ Ambiente limpo e pronto para reprocessamento.\n")
 
+def reload_from_stage(orchestrator, staging=None, datasets=None):
+    """Recarrega as fatos a partir do staging Parquet, sem baixar nada (ex: depois
+    de mudar mappings ou o schema sobre colunas já staged). As linhas antigas de cada recurso são apagadas
+    antes da recarga. Arquivos sem alguma coluna que a config passou a exigir
+    ficam de fora: o próximo download do recurso regrava o staging."""
+    staging = staging or StagingArea()
+    for key, config in CONFIG_MAP.items():
+        if datasets and key not in datasets: continue
+        req_cols = extract_required_columns(config)
+        for path, meta in staging.entries(key):
+            if not staging.covers(meta, req_cols):
+                missing = sorted(c for c in set(req_cols) - set(meta["colunas"]) if not c.startswith("LIT_"))
+                logging.warning(f"⚠️ Staging sem as colunas {missing}, recurso precisa ser baixado de novo: {path}")
+                continue
+            job_config = {**config, "source": {**config["source"], "path": path, "url": meta.get("url"),
+                                               "version": meta.get("sha256"), "restart": True}}
+            try:
+                orchestrator.run(job_config)
+            except Exception as e:
+                logging.error(f"🔥 Erro ao recarregar {path}: {e}")
+
 def main():
     tracker = ProcessTracker()
     orchestrator = ETLEngine()
-    fetcher = DataFetcher(output_temp_file="temp_stage.csv")
-
-    RESET_ON_START = True 
-
-    if RESET_ON_START:
+    fetcher = DataFetcher()
+
+    # Com o tracker de versões, só recursos novos ou alterados são recarregados
+    RESET_ON_START = False
+    # Recarrega tudo do staging Parquet (lake/) em vez de baixar do opendatasus
+    RELOAD_FROM_STAGE = False
+    # Cria os índices que o index_advisor sugere a partir do corpus de consultas
+    ADVISE_INDEXES = False
+    # Mantém uma cópia DuckDB do star schema (DUCKDB_PATH) para a API e as avaliações locais
+    MIRROR_DUCKDB = False
+    # Reseta também se alguma fato tiver linhas sem arquivo_origem_id (ex: cargas de
+    # caminho local). Apaga todas as tabelas, então nunca é automático
+    RESET_UNTAGGED_ROWS = False
+
+    # Banco carregado por uma versão sem a coluna arquivo_origem_id: essas linhas não
+    # podem ser substituídas por recurso, então a migração é um reset único
+    untagged = orchestrator.db.untagged_fact_tables(
+        [c["fact"]["target_table"] for c in CONFIG_MAP.values() if "fact" in c], include_rows=RESET_UNTAGGED_ROWS)
+    if untagged and not RESET_ON_START:
+        logging.warning(f"⚠️ Fatos sem arquivo_origem_id ({', '.join(untagged)}): "
+                        "reset único para não duplicar o histórico.")
+
+    if RESET_ON_START or untagged:
         reset_environment(orchestrator.db.engine, tracker.tracking_file)
+        orchestrator.db.reset_caches()
         tracker = ProcessTracker()
 
-    for key, url in DATASET_URLS.items():
-        logging.info(f"\n{'='*50}\n🔎 Dataset: {key}\n{'='*50}")
-        config = CONFIG_MAP.get(key)
-        if not config: continue
+    if MIRROR_DUCKDB:
+        orchestrator.mirror = DuckDBMirror(orchestrator.db)
+        # Como no fim de cada carga: uma falha não impede a ingestão
+        if orchestrator.sync_mirror():
+            orchestrator.data_version.bump()
 
-        req_cols = extract_required_columns(config)
-        page = fetcher.fetch_page(url)
-        if not page: continue
-
-        resources = page.find_all("li", class_="resource-item")
-        valid_urls = []
-        for res in resources:
-            link = res.find("a", class_="resource-url-analytics")
-            if not link: continue
-            file_url = link['href']
-            
-            # --- FIX: Filtro mais abrangente ---
-            # Aceita se tiver .csv no nome OU se terminar em .zip
-            ext = file_url.lower()
-            if '.csv' in ext or (ext.endswith('.zip') and not ('json' in ext or 'xml' in ext)):
-                full_url = urljoin(url, file_url)
-                valid_urls.append(full_url)
-            # -----------------------------------
-
-        # Ordena tentativa de processamento cronológico
-        valid_urls.sort(key=lambda x: get_year_from_url(x), reverse=False)
-
-        if not valid_urls:
-            logging.warning(f"⚠️ Nenhum arquivo compatível (CSV/ZIP) encontrado para {key}")
-
-        for file_url in valid_urls:           
-            if tracker.is_processed(file_url):
-                print(f"⏩ Pulando: {os.path.basename(file_url)}")
-                continue
+    if ADVISE_INDEXES:
+        from index_advisor import advise
+        orchestrator.db.plan_indexes(advise(orchestrator.db))
 
-            success = fetcher.download_and_save(file_url, required_columns=req_cols)
-            if success:
-                try:
-                    config['source']['path'] = "temp_stage.csv"
-                    orchestrator.run(config)
-                    tracker.mark_processed(file_url)
-                except Exception as e:
-                    logging.error(f"🔥 Erro no ETL: {e}")
-                
-                if os.path.exists("temp_stage.csv"): os.remove("temp_stage.csv")
+    if RELOAD_FROM_STAGE:
+        reload_from_stage(orchestrator)
+    else:
+        scheduler = IngestScheduler(orchestrator, tracker)
+
+        for key, url in DATASET_URLS.items():
+            logging.info(f"\n{'='*50}\n🔎 Dataset: {key}\n{'='*50}")
+            config = CONFIG_MAP.get(key)
+            if not config: continue
+
+            page = fetcher.fetch_page(url)
+            if not page: continue
+
+            resources = page.find_all("li", class_="resource-item")
+            valid_urls = []
+            for res in resources:
+                link = res.find("a", class_="resource-url-analytics")
+                if not link: continue
+                file_url = link['href']
             
-            gc.collect()
-            time.sleep(1)
+                # --- FIX: Filtro mais abrangente ---
+                # Aceita se tiver .csv no nome OU se terminar em .zip
+                ext = file_url.lower()
+                if '.csv' in ext or (ext.endswith('.zip') and not ('json' in ext or 'xml' in ext)):
+                    full_url = urljoin(url, file_url)
+                    valid_urls.append(full_url)
+                # -----------------------------------
+
+            # Ordena tentativa de processamento cronológico
+            valid_urls.sort(key=lambda x: get_year_from_url(x), reverse=False)
+
+            if not valid_urls:
+                logging.warning(f"⚠️ Nenhum arquivo compatível (CSV/ZIP) encontrado para {key}")
+
+            # Recursos já processados também entram: o download condicional decide se mudaram
+            scheduler.add_dataset(key, config, valid_urls)
+
+        # Downloads e cargas de todos os datasets rodam sobrepostos
+        scheduler.run()
+
+    # Views desnormalizadas do text-to-SQL (schema consulta) refletem a nova carga
+    orchestrator.refresh_views()
+    orchestrator.close()
 
     # --- RELATÓRIO FINAL ---
     print("\n" + "="*40)
@@ -841,6 +2873,13 @@ def main():
             print(f"{table:<30} | {count:>20,}".replace(",", "."))
     else:
         print("Nenhum dado novo foi adicionado.")
+    metrics = orchestrator.db.metrics.snapshot()
+    print("-" * 53)
+    for name, t in metrics["timings"].items():
+        print(f"⏱️  {name:<26} | n={t['n']} média={t['avg_ms']}ms máx={t['max_ms']}ms")
+    for name, n in metrics["counters"].items():
+        print(f"🔢 {name:<27} | {n}")
+    print(f"🏊 Pool: {orchestrator.db.pool_status()}")
     print("="*40 + "\n")
     
 if __name__ == "__main__":
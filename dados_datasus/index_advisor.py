@@ -0,0 +1,374 @@
+"""
+Sugestão de índices para o datalake a partir do corpus de consultas.
+
+Lê as consultas de `sample.py` (selected_queries / generated_queries) e de
+`generated_queries.py`, extrai com sqlparse as colunas usadas em filtros
+(WHERE), junções (ON) e agrupamentos (GROUP BY) de cada tabela e propõe
+índices B-tree (colunas de igualdade/junção) e BRIN (colunas de data cuja
+ordem física acompanha os valores, segundo o pg_stats). As relações são resolvidas
+como na API (views do schema de consulta antes do star schema). Com --create os
+índices são registrados no SGBDLoader e criados via ensure_indexes (tabelas) ou
+QueryViews (views de consulta); o relatório compara o custo do EXPLAIN de cada
+consulta antes e depois.
+
+Uso:
+    python index_advisor.py              # só propõe e mostra custos
+    python index_advisor.py --create     # cria os índices e compara custos
+"""
+import os
+import ast
+import json
+import logging
+import argparse
+from collections import Counter, defaultdict
+
+import pandas as pd
+import sqlparse
+from sqlparse import sql as sql_tokens
+from sqlparse import tokens as T
+from sqlalchemy import text
+
+from datalake import SGBDLoader, QueryViews, DATABASE_URL, QUERY_SCHEMA
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Arquivo do corpus -> listas (atribuições no topo do módulo) com os dicts de consulta
+CORPUS_FILES = {
+    "sample.py": ("selected_queries", "generated_queries"),
+    "generated_queries.py": ("generated_queries",),
+}
+# Uma coluna só vira índice se aparecer em pelo menos tantas consultas distintas
+MIN_USES = 2
+# Schemas em que as relações do corpus são resolvidas, na ordem do search_path
+SEARCH_PATH = (QUERY_SCHEMA, "public")
+TEMPORAL_TYPES = ("date", "timestamp without time zone", "timestamp with time zone")
+# BRIN só compensa se a ordem física da coluna acompanha os valores (|correlação| no pg_stats)
+BRIN_MIN_CORRELATION = 0.9
+
+# ==============================================================================
+# 1. CORPUS
+# ==============================================================================
+def load_corpus(root=REPO_ROOT):
+    """SQLs distintos do corpus. Os arquivos são lidos com ast (sem importar
+    sample.py, que depende de rich), e repetições entre paráfrases são removidas."""
+    queries = {}
+    for file_name, names in CORPUS_FILES.items():
+        path = os.path.join(root, file_name)
+        if not os.path.exists(path):
+            logging.warning(f"⚠️ Corpus não encontrado: {path}")
+            continue
+        with open(path, encoding="utf-8") as f:
+            tree = ast.parse(f.read(), filename=path)
+        for node in tree.body:
+            if not isinstance(node, ast.Assign): continue
+            if not any(isinstance(t, ast.Name) and t.id in names for t in node.targets): continue
+            for item in ast.literal_eval(node.value):
+                sql = (item.get("sql_query") or "").strip()
+                if sql:
+                    queries.setdefault(" ".join(sql.rstrip(";").split()).lower(), sql)
+    logging.info(f"📚 Corpus: {len(queries)} consultas distintas")
+    return list(queries.values())
+
+# ==============================================================================
+# 2. EXTRAÇÃO DE COLUNAS (sqlparse)
+# ==============================================================================
+def _is_subquery(token):
+    return isinstance(token, sql_tokens.Parenthesis) and any(t.ttype is T.DML for t in token.tokens)
+
+def _leaves(token, subqueries):
+    """Folhas de um trecho da consulta; subconsultas ficam de fora (são analisadas
+    no seu próprio escopo) e vão para `subqueries`."""
+    if _is_subquery(token):
+        subqueries.append(token)
+        return
+    if token.is_group:
+        for child in token.tokens:
+            yield from _leaves(child, subqueries)
+    elif not token.is_whitespace and token.ttype not in T.Comment:
+        yield token
+
+def _column_refs(token, subqueries):
+    """(qualificador ou None, coluna) de cada referência a coluna no trecho."""
+    leaves = list(_leaves(token, subqueries))
+    refs = []
+    for i, leaf in enumerate(leaves):
+        if leaf.ttype is T.Name or leaf.ttype is T.Literal.String.Symbol:
+            nxt = leaves[i + 1].value if i + 1 < len(leaves) else ""
+            prev = leaves[i - 1].value if i > 0 else ""
+            # Nome de função, qualificador (tratado com a coluna) ou tipo de cast
+            if nxt in ("(", ".") or prev == "::": continue
+            name = leaf.value.strip('"').lower()
+            qualifier = leaves[i - 2].value.strip('"').lower() if prev == "." and i > 1 else None
+            refs.append((qualifier, name))
+    return refs
+
+def _scan_scope(scope, usage, ctes=frozenset()):
+    """Analisa um SELECT (statement ou subconsulta) e acumula em `usage`
+    {tabela: {coluna: set(papéis)}} as colunas de filter/join/group."""
+    aliases, refs, subqueries = {}, [], []
+    ctes = set(ctes)
+    clause = None
+
+    for token in scope.tokens:
+        if token.is_whitespace or token.ttype in T.Comment or token.ttype is T.Punctuation:
+            continue
+        keyword = token.normalized if token.ttype in T.Keyword else None
+
+        if token.ttype is T.Keyword.CTE:
+            clause = "cte"
+        elif token.ttype is T.DML:
+            clause = "select"
+        elif keyword == "FROM" or (keyword and keyword.endswith("JOIN")):
+            clause = "from"
+        elif keyword == "ON":
+            clause = "join"
+        elif keyword == "GROUP BY":
+            clause = "group"
+        elif keyword is not None:
+            # ORDER BY, HAVING, LIMIT, UNION...: sem colunas indexáveis por aqui
+            clause = None
+        elif isinstance(token, sql_tokens.Where):
+            refs += [(q, c, "filter") for q, c in _column_refs(token, subqueries)]
+            clause = None
+        elif clause == "cte":
+            for ident in (token.get_identifiers() if isinstance(token, sql_tokens.IdentifierList) else [token]):
+                if not isinstance(ident, sql_tokens.Identifier): continue
+                ctes.add(ident.get_name().lower())
+                subqueries += [t for t in ident.tokens if _is_subquery(t)]
+        elif clause == "from":
+            for ident in (token.get_identifiers() if isinstance(token, sql_tokens.IdentifierList) else [token]):
+                if not isinstance(ident, sql_tokens.Identifier): continue
+                inner = [t for t in ident.tokens if _is_subquery(t)]
+                if inner:
+                    subqueries += inner
+                    aliases[(ident.get_alias() or "").lower()] = None
+                    continue
+                real = ident.get_real_name().lower()
+                table = None if real in ctes else real
+                aliases[real] = table
+                aliases[(ident.get_alias() or real).lower()] = table
+        elif clause in ("join", "group"):
+            refs += [(q, c, clause) for q, c in _column_refs(token, subqueries)]
+        else:
+            # Lista do SELECT etc.: só interessam subconsultas escalares
+            list(_leaves(token, subqueries))
+
+    # Colunas sem qualificador só são atribuídas quando há uma única tabela real no escopo
+    real_tables = {t for t in aliases.values() if t}
+    for qualifier, column, role in refs:
+        if qualifier is not None:
+            table = aliases.get(qualifier)
+        else:
+            table = next(iter(real_tables)) if len(real_tables) == 1 else None
+        if table:
+            usage[table][column].add(role)
+
+    for sub in subqueries:
+        _scan_scope(sub, usage, ctes)
+
+def analyze_query(sql):
+    """{tabela: {coluna: set(papéis)}} de uma consulta."""
+    usage = defaultdict(lambda: defaultdict(set))
+    for statement in sqlparse.parse(sql):
+        if statement.get_type() != "UNKNOWN":
+            _scan_scope(statement, usage)
+    return usage
+
+def analyze_corpus(queries):
+    """Contagem, por tabela e coluna, de consultas que usam a coluna em cada papel,
+    e dos pares (filtro, agrupamento) que aparecem juntos na mesma consulta."""
+    counts = defaultdict(lambda: defaultdict(Counter))
+    pairs = defaultdict(Counter)
+    for sql in queries:
+        try:
+            usage = analyze_query(sql)
+        except Exception as e:
+            logging.warning(f"⚠️ Consulta ignorada ({e}): {sql[:80]}")
+            continue
+        for table, columns in usage.items():
+            for column, roles in columns.items():
+                counts[table][column].update(roles)
+            filters = [c for c, r in columns.items() if "filter" in r]
+            groups = [c for c, r in columns.items() if "group" in r]
+            pairs[table].update((f, g) for f in filters for g in groups if f != g)
+    return counts, pairs
+
+# ==============================================================================
+# 3. PROPOSTA DE ÍNDICES
+# ==============================================================================
+def column_catalog(engine, schemas=SEARCH_PATH):
+    """({tabela: {coluna: tipo}}, {tabela: {coluna: correlação}}, {tabela: schema}) das
+    tabelas e views materializadas. Um nome sem schema é resolvido como no search_path
+    `schemas`: vale a relação do primeiro schema que a tem (consulta.leitos antes de
+    public.leitos), e o terceiro dict diz qual foi. A correlação vem do pg_stats e
+    fica None se a relação ainda não foi analisada."""
+    rank = {schema: i for i, schema in enumerate(schemas)}
+    resolved = {}
+    types, correlations = defaultdict(dict), defaultdict(dict)
+    with engine.connect() as conn:
+        rows = conn.execute(text(
+            "SELECT n.nspname, c.relname, a.attname, format_type(a.atttypid, a.atttypmod), s.correlation "
+            "FROM pg_attribute a JOIN pg_class c ON c.oid = a.attrelid "
+            "JOIN pg_namespace n ON n.oid = c.relnamespace "
+            "LEFT JOIN pg_stats s ON s.schemaname = n.nspname AND s.tablename = c.relname AND s.attname = a.attname "
+            "WHERE n.nspname = ANY(:schemas) AND c.relkind IN ('r', 'p', 'm') "
+            "AND a.attnum > 0 AND NOT a.attisdropped"), {"schemas": list(schemas)})
+        for nsp, t_name, col, ctype, corr in rows:
+            table = t_name.lower()
+            if rank[nsp] > resolved.setdefault(table, rank[nsp]): continue
+            if rank[nsp] < resolved[table]:
+                # Relação de um schema anterior no search_path esconde a que já foi lida
+                resolved[table] = rank[nsp]
+                types[table].clear()
+                correlations[table].clear()
+            types[table][col.lower()] = ctype
+            correlations[table][col.lower()] = corr
+    return dict(types), dict(correlations), {table: schemas[i] for table, i in resolved.items()}
+
+def column_types(engine, schemas=SEARCH_PATH):
+    """{tabela: {coluna: tipo}}, resolvido pelo search_path (ver column_catalog)."""
+    return column_catalog(engine, schemas)[0]
+
+def _is_temporal(table, column, types):
+    ctype = types.get(table, {}).get(column)
+    return ctype is not None and ctype.startswith(TEMPORAL_TYPES)
+
+def _use_brin(table, column, types, correlations):
+    """BRIN para colunas de data (pelo tipo no catálogo) quase ordenadas fisicamente.
+    Sem estatísticas (relação nunca analisada) fica o B-tree."""
+    corr = correlations.get(table, {}).get(column)
+    return _is_temporal(table, column, types) and corr is not None and abs(corr) >= BRIN_MIN_CORRELATION
+
+def propose_indexes(counts, pairs, types=None, min_uses=MIN_USES, correlations=None):
+    """Lista de índices sugeridos (dicts com table, columns, method, uses e reason).
+
+    - coluna de filtro/junção em >= min_uses consultas: BRIN se for data com
+      correlação física >= BRIN_MIN_CORRELATION (`correlations`, do pg_stats), senão B-tree;
+    - par (filtro, agrupamento) mais frequente de cada tabela: B-tree composto,
+      que permite ler o filtro já na ordem do GROUP BY.
+    Com `types` (catálogo), colunas que não existem na tabela são descartadas.
+    """
+    types = types or {}
+    correlations = correlations or {}
+    proposals = []
+    for table, columns in counts.items():
+        known = types.get(table)
+        for column, roles in columns.items():
+            if known is not None and column not in known: continue
+            uses = roles["filter"] + roles["join"]
+            if uses < min_uses: continue
+            method = "brin" if _use_brin(table, column, types, correlations) else "btree"
+            reason = "/".join(r for r in ("filter", "join") if roles[r])
+            proposals.append({"table": table, "columns": [column], "method": method, "uses": uses, "reason": reason})
+
+        candidates = [(pair, n) for pair, n in pairs[table].most_common()
+                      if n >= min_uses and not _is_temporal(table, pair[0], types)
+                      and (known is None or set(pair) <= set(known))]
+        if candidates:
+            (f, g), n = candidates[0]
+            proposals.append({"table": table, "columns": [f, g], "method": "btree", "uses": n, "reason": "filter+group"})
+
+    return sorted(proposals, key=lambda p: (p["table"], -p["uses"]))
+
+# ==============================================================================
+# 4. CUSTOS (EXPLAIN)
+# ==============================================================================
+def explain_costs(engine, queries):
+    """Custo total estimado de cada consulta (None + erro se ela não roda no schema atual)."""
+    results = []
+    raw = engine.raw_connection()
+    try:
+        for sql in queries:
+            cur = raw.cursor()
+            try:
+                # Como a API: views de consulta antes do star schema (LOCAL: some no rollback)
+                cur.execute(f"SET LOCAL search_path TO {', '.join(SEARCH_PATH)}")
+                cur.execute(f"EXPLAIN (FORMAT JSON) {sql.strip().rstrip(';')}")
+                plan = cur.fetchone()[0]
+                plan = json.loads(plan) if isinstance(plan, str) else plan
+                results.append({"cost": plan[0]["Plan"]["Total Cost"], "error": None})
+            except Exception as e:
+                results.append({"cost": None, "error": str(e).splitlines()[0]})
+            finally:
+                cur.close()
+                raw.rollback()
+    finally:
+        raw.close()
+    return results
+
+def cost_report(queries, before, after=None):
+    df = pd.DataFrame({
+        "consulta": [" ".join(q.split())[:70] for q in queries],
+        "custo_antes": pd.Series([r["cost"] for r in before], dtype=float),
+        "erro": [r["error"] for r in before],
+    })
+    if after is not None:
+        df["custo_depois"] = pd.Series([r["cost"] for r in after], dtype=float)
+        df["reducao_%"] = ((1 - df["custo_depois"] / df["custo_antes"]) * 100).round(1)
+    return df
+
+# ==============================================================================
+# 5. EXECUÇÃO
+# ==============================================================================
+def advise(db=None, queries=None, min_uses=MIN_USES):
+    """Propõe índices para o schema atual do banco (usado também pelo main do datalake).
+    Relações resolvidas fora do public saem com o schema no nome (consulta.leitos),
+    como o SGBDLoader.plan_indexes e o QueryViews as procuram."""
+    db = db or SGBDLoader(DATABASE_URL)
+    queries = queries if queries is not None else load_corpus()
+    counts, pairs = analyze_corpus(queries)
+    types, correlations, resolved = column_catalog(db.engine)
+    proposals = propose_indexes(counts, pairs, types, min_uses, correlations)
+    for p in proposals:
+        schema = resolved.get(p["table"], "public")
+        if schema != "public": p["table"] = f"{schema}.{p['table']}"
+    return proposals
+
+def create_indexes(db, proposals):
+    """Cria os índices propostos: nas views de consulta via QueryViews, nas
+    tabelas via SGBDLoader. Devolve as relações que ganharam índices planejados."""
+    db.plan_indexes(proposals)
+    views = QueryViews(db)
+    relations = sorted({p["table"] for p in proposals if db.schema.has_table(p["table"])})
+    for relation in relations:
+        schema, _, name = relation.rpartition(".")
+        if schema == QUERY_SCHEMA and name in views.views:
+            views._ensure_indexes(name)
+        else:
+            db.ensure_indexes(relation)
+    return relations
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sugere (e cria) índices a partir do corpus de consultas.")
+    parser.add_argument("--create", action="store_true", help="cria os índices sugeridos e compara os custos")
+    parser.add_argument("--min-uses", type=int, default=MIN_USES, help="consultas mínimas por coluna indexada")
+    parser.add_argument("--corpus-root", default=REPO_ROOT, help="pasta com sample.py e generated_queries.py")
+    args = parser.parse_args(argv)
+
+    db = SGBDLoader(DATABASE_URL)
+    queries = load_corpus(args.corpus_root)
+    proposals = advise(db, queries, args.min_uses)
+
+    print("\n📇 ÍNDICES SUGERIDOS")
+    if proposals:
+        print(pd.DataFrame(proposals).to_string(index=False))
+    else:
+        print("Nenhum índice sugerido para o schema atual.")
+
+    before = explain_costs(db.engine, queries)
+    after = None
+    if args.create and proposals:
+        tables = create_indexes(db, proposals)
+        # Estatísticas atualizadas para o planner considerar os índices novos
+        with db.engine.begin() as conn:
+            for table in tables:
+                conn.execute(text(f"ANALYZE {table};"))
+        after = explain_costs(db.engine, queries)
+
+    report = cost_report(queries, before, after)
+    failed = report["erro"].notna().sum()
+    print(f"\n📊 CUSTOS DO EXPLAIN ({len(report) - failed} consultas válidas no schema atual, {failed} com erro)")
+    print(report[report["erro"].isna()].drop(columns="erro").to_string(index=False))
+    return proposals, report
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Teste de carga das rotas de consulta da API (query_service).
+
+Dispara as consultas do corpus (`sample.py` / `generated_queries.py`, lidas
+como no index_advisor) ou de um arquivo com um SQL por linha, a partir de N
+clientes simultâneos, e mostra vazão e latências p50/p99. Por padrão o cache
+de resultados é desligado, para medir o caminho de execução no DuckDB.
+
+Uso:
+    python load_test.py                              # 32 clientes, corpus, sem cache
+    python load_test.py --clients 8 --requests 400 --sql-file consultas.sql --cache
+"""
+import json
+import time
+import argparse
+import urllib.error
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from index_advisor import load_corpus
+
+API_URL = "http://localhost:8000/consulta"
+
+def post_query(url, sql, cache):
+    """Uma requisição; devolve (segundos, status HTTP)."""
+    body = json.dumps({"sql": sql, "cache": cache}).encode("utf-8")
+    req = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"})
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=300) as resp:
+            resp.read()
+            status = resp.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except urllib.error.URLError:
+        status = 0
+    return time.perf_counter() - start, status
+
+def run_load(url, queries, clients=32, requests_total=640, cache=False):
+    """Cada cliente percorre o corpus a partir de um deslocamento próprio."""
+    per_client = max(1, requests_total // clients)
+
+    def client(n):
+        return [post_query(url, queries[(n * per_client + i) % len(queries)], cache) for i in range(per_client)]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        results = [r for batch in pool.map(client, range(clients)) for r in batch]
+    elapsed = time.perf_counter() - start
+
+    latencies = np.array([t for t, _ in results]) * 1000
+    return {
+        "clientes": clients,
+        "requisicoes": len(results),
+        "status": dict(Counter(status for _, status in results)),
+        "vazao_rps": round(len(results) / elapsed, 1),
+        "p50_ms": round(float(np.percentile(latencies, 50)), 1),
+        "p99_ms": round(float(np.percentile(latencies, 99)), 1),
+        "max_ms": round(float(latencies.max()), 1),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Teste de carga das rotas de consulta")
+    parser.add_argument("--url", default=API_URL)
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=640)
+    parser.add_argument("--sql-file", help="arquivo com um SQL por linha (padrão: corpus)")
+    parser.add_argument("--cache", action="store_true", help="usa o cache de resultados da API")
+    args = parser.parse_args()
+
+    if args.sql_file:
+        with open(args.sql_file, encoding="utf-8") as f:
+            queries = [line.strip() for line in f if line.strip()]
+    else:
+        queries = load_corpus()
+
+    report = run_load(args.url, queries, args.clients, args.requests, args.cache)
+    print(f"🚦 {report['requisicoes']} requisições de {report['clientes']} clientes: "
+          f"{report['vazao_rps']} req/s | p50 {report['p50_ms']} ms | p99 {report['p99_ms']} ms | "
+          f"máx {report['max_ms']} ms | status {report['status']}")
+
+if __name__ == "__main__":
+    main()
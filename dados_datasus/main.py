@@ -2,6 +2,7 @@ from fastapi import FastAPI
 from contextlib import asynccontextmanager
 from app.rotas import rotas
 from app.database.duckDB_system import db_instance
+import query_service
 import uvicorn
  
 # --- CICLO DE VIDA ---
@@ -14,11 +15,16 @@ async def lifespan(app: FastAPI):
         db_instance.get_connection()
     except Exception as e:
         print(f"AVISO: Não foi possível conectar ao Banco: {e}")
+    try:
+        query_service.service.connect()
+    except Exception as e:
+        print(f"AVISO: Não foi possível abrir o espelho DuckDB: {e}")
     
     yield # O servidor roda aqui
     
     # Código que roda ao desligar
     db_instance.close()
+    query_service.service.close()
 
 app = FastAPI(
     title="API DataSUS via FastAPI",
@@ -29,6 +35,7 @@ app = FastAPI(
 
 # Inclui as rotas
 app.include_router(rotas.router)
+app.include_router(query_service.router)
 
 @app.get("/")
 def root():
@@ -0,0 +1,120 @@
+"""
+Micro-benchmark dos conversores de tipo do mapping (datalake.get_parser) e
+da limpeza de texto (Sanitizer.clean_generic).
+
+Gera valores sintéticos com semente fixa, no formato dos CSVs do DATASUS
+(decimais com '.' de milhar e ',' decimal, datas ISO e a COMP YYYYMM dos
+leitos), e compara o conversor atual com a conversão por inferência que o
+apply_mapping usava antes dos formatos declarados. Mostra o melhor de N
+repetições, quantos valores cada caminho deixou nulos e em quantos os dois
+discordam (o caminho antigo perdia o sinal dos decimais negativos).
+
+A limpeza de texto roda sobre um DataFrame por config, com as colunas que
+ela usa (extract_required_columns) preenchidas com texto sujo: espaços nas
+pontas, minúsculas, sentinelas ('nan', ' n/a ', 'None', '') e nulos reais.
+Compara o clean_generic anterior (pandas .str) com o atual (kernels Arrow).
+
+Uso:
+    python parser_bench.py                    # 500k valores, 200k linhas na limpeza, 5 repetições
+    python parser_bench.py --rows 100000 --clean-rows 50000 --repeat 10 --seed 7
+"""
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from datalake import CONFIG_MAP, Sanitizer, extract_required_columns, get_parser
+
+# Texto como chega nos CSVs; as sentinelas viram nulo na limpeza
+TEXT_VALUES = ["hospital municipal", "  SAO PAULO ", "Rede Própria", "12345678000199", "3550308",
+               " n/a ", "nan", "None", "", None]
+
+def legacy_decimal(col_series):
+    """Conversão de decimais anterior aos formatos declarados."""
+    s = col_series.astype(str).str.replace('.', '', regex=False).str.replace(',', '.', regex=False)
+    s = s.str.replace(r'[^0-9.]', '', regex=True)
+    return pd.to_numeric(s, errors='coerce')
+
+def legacy_date(col_series):
+    """Conversão de datas anterior aos formatos declarados (só inferência)."""
+    return pd.to_datetime(col_series, errors='coerce', utc=True).dt.date
+
+def legacy_clean_generic(df):
+    """Limpeza de texto anterior aos kernels Arrow (todas as colunas)."""
+    for col in df.columns:
+        df[col] = df[col].astype(str).str.strip().str.upper()
+        df[col] = df[col].replace(['NAN', 'NONE', '', 'N/A'], None)
+    return df
+
+def make_text_frames(rows, seed):
+    """Um DataFrame de texto por config, com as colunas que ela usa."""
+    rng = np.random.default_rng(seed)
+    values = np.array(TEXT_VALUES, dtype=object)
+    return {key: pd.DataFrame({col: values[rng.integers(0, len(values), rows)]
+                               for col in sorted(extract_required_columns(config))})
+            for key, config in CONFIG_MAP.items()}
+
+def make_samples(rows, seed):
+    """Séries de texto como chegam do CSV, com ~1% de vazios."""
+    rng = np.random.default_rng(seed)
+    values = rng.uniform(-50_000, 50_000, rows).round(2)
+    decimals = pd.Series([f"{v:,.2f}".replace(",", "_").replace(".", ",").replace("_", ".") for v in values])
+    days = pd.Timestamp("2015-01-01") + pd.to_timedelta(rng.integers(0, 3650, rows), unit="D")
+    dates = pd.Series(days.strftime("%Y-%m-%d"))
+    comps = pd.Series(days.strftime("%Y%m"))
+    blanks = rng.random(rows) < 0.01
+    for s in (decimals, dates, comps):
+        s[blanks] = None
+    return {
+        "decimal br": (decimals, legacy_decimal, get_parser("decimal", "br")),
+        "date %Y-%m-%d": (dates, legacy_date, get_parser("date", "%Y-%m-%d")),
+        "date %Y%m (COMP)": (comps, legacy_date, get_parser("date", "%Y%m")),
+    }
+
+def best_of(func, series, repeat):
+    """Melhor tempo de `repeat` execuções e o resultado da última."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = func(series)
+        timings.append(time.perf_counter() - start)
+    return min(timings), out
+
+def best_of_frame(func, df, repeat):
+    """Como best_of, mas cada execução limpa uma cópia nova (a limpeza é in-place)."""
+    timings = []
+    for _ in range(repeat):
+        data = df.copy()
+        start = time.perf_counter()
+        out = func(data)
+        timings.append(time.perf_counter() - start)
+    return min(timings), out
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmark dos conversores do mapping")
+    parser.add_argument("--rows", type=int, default=500_000)
+    parser.add_argument("--clean-rows", type=int, default=200_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    print(f"⏱️ {args.rows} valores, melhor de {args.repeat}, semente {args.seed}")
+    for name, (series, legacy, current) in make_samples(args.rows, args.seed).items():
+        t_old, old = best_of(legacy, series, args.repeat)
+        t_new, new = best_of(current, series, args.repeat)
+        both = old.notna() & new.notna()
+        diverging = int((old[both] != new[both]).sum())
+        print(f"  {name:<18} {t_old:.3f}s ({old.isna().sum()} nulos) -> "
+              f"{t_new:.3f}s ({new.isna().sum()} nulos) | {t_old / t_new:.1f}x | {diverging} divergentes")
+
+    print(f"🧽 clean_generic, {args.clean_rows} linhas por config")
+    for key, df in make_text_frames(args.clean_rows, args.seed).items():
+        t_old, old = best_of_frame(legacy_clean_generic, df, args.repeat)
+        t_new, new = best_of_frame(Sanitizer.clean_generic, df, args.repeat)
+        diverging = int((old.isna() != new.isna()).to_numpy().sum() + (old.fillna("") != new.fillna("")).to_numpy().sum())
+        print(f"  {key:<18} {len(df.columns)} colunas | {len(df) / t_old / 1000:.0f}k -> "
+              f"{len(df) / t_new / 1000:.0f}k linhas/s | {t_old / t_new:.1f}x | {diverging} divergentes")
+
+if __name__ == "__main__":
+    main()
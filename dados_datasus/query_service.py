@@ -0,0 +1,729 @@
+"""
+Serviço de consultas SQL da API sobre o espelho DuckDB do datalake.
+
+As avaliações de text-to-SQL executam o mesmo SQL muitas vezes (as paráfrases
+de `generated_queries.py` repetem quase sempre a mesma `sql_query`). Os
+resultados ficam em um cache LRU, limitado em entradas e em bytes, cuja chave
+é o SQL normalizado por sqlparse.format. O cache inteiro é invalidado quando
+a versão dos dados (DataVersion, incrementada pelo ETL ao fim de cada carga)
+muda.
+
+As consultas rodam em um pool de cursores DuckDB (um por núcleo, todos sobre
+a mesma base aberta em modo leitura), em threads: as rotas são async e não
+seguram o event loop nem um único cursor compartilhado. O ETL publica cada
+sync do espelho num arquivo novo (rename atômico); quando a versão dos dados
+muda, o pool é reaberto sobre ele e a conexão anterior é fechada assim que
+suas consultas em andamento devolvem os cursores.
+
+Resultados grandes podem ser lidos em streaming (/consulta/stream): lotes
+Arrow lidos direto do cursor e enviados como Arrow IPC ou NDJSON, sem montar o
+resultado inteiro na memória e sem passar pelo cache.
+
+Nenhuma consulta monopoliza o servidor: cada uma tem tempo limite e é
+interrompida (cursor.interrupt) se o cliente desconecta; antes de rodar, o
+custo estimado pelo EXPLAIN decide se ela entra direto, espera na fila das
+pesadas ou é recusada; e cada tenant (cabeçalho X-Tenant) tem um número
+limitado de consultas simultâneas.
+
+Consultas que só diferem nos literais ('SP' / 'RJ', LIMIT 3 / 5) compartilham
+um statement preparado: os literais de WHERE, HAVING, ON, LIMIT e OFFSET viram
+parâmetros ($1, $2...) e cada cursor guarda um PREPARE por formato (LRU), de
+modo que as repetições pulam parse e planejamento.
+
+Rotas:
+    POST /consulta          {"sql": "...", "cache": true} -> colunas, linhas e se veio do cache
+    POST /consulta/stream   {"sql": "...", "formato": "arrow" | "ndjson", "lote": 8192}
+    GET  /consulta/cache    métricas do cache de resultados e dos statements preparados
+    GET  /consulta/admissao contadores do controle de admissão
+"""
+import io
+import os
+import json
+import time
+import queue
+import asyncio
+import threading
+from collections import Counter, OrderedDict
+from contextlib import AsyncExitStack, asynccontextmanager, contextmanager
+from functools import lru_cache
+from typing import Literal
+
+import duckdb
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import sqlparse
+from sqlparse import lexer
+from sqlparse import tokens as T
+from fastapi import APIRouter, Header, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+
+from datalake import DataVersion, DUCKDB_PATH, QUERY_SCHEMA
+
+# Limites do cache de resultados: o que for atingido primeiro remove a entrada menos usada
+CACHE_MAX_ENTRIES = 512
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+# Cursores DuckDB para consultas simultâneas; além disso, as requisições esperam na fila
+CURSOR_POOL_SIZE = os.cpu_count() or 4
+# Nome com que o espelho é anexado (somente leitura) à conexão do pool
+MIRROR_CATALOG = "espelho"
+# Linhas por lote Arrow nas respostas em streaming (múltiplo do vetor do DuckDB)
+STREAM_BATCH_ROWS = 8192
+# Statements preparados por cursor (LRU; os removidos são desalocados)
+STATEMENT_CACHE_SIZE = 128
+# Textos de SQL com forma normalizada / parametrizada memorizada (por texto exato)
+SQL_TEXT_CACHE_SIZE = 4096
+# Cláusulas cujos literais viram parâmetros. Nas demais (SELECT, GROUP BY,
+# ORDER BY...) um literal muda o nome da coluna ou é uma posição, não um valor
+PARAM_CLAUSES = {"WHERE", "HAVING", "ON", "LIMIT", "OFFSET"}
+CLAUSE_KEYWORDS = PARAM_CLAUSES | {"SELECT", "FROM", "GROUP BY", "ORDER BY", "WITH", "QUALIFY", "WINDOW",
+                                   "UNION", "UNION ALL", "EXCEPT", "INTERSECT"}
+# Literais tipados (DATE '2023-01-01', INTERVAL 3 DAY) ficam no texto
+TYPED_LITERAL_PREFIXES = {"DATE", "TIME", "TIMESTAMP", "INTERVAL"}
+PARAM_TOKENS = (T.Literal.String.Single, T.Literal.Number.Integer, T.Literal.Number.Float)
+
+# Tempo limite (s) de uma consulta; no streaming vale para a leitura inteira
+QUERY_TIMEOUT_S = 30
+STREAM_TIMEOUT_S = 300
+# Admissão pelo custo estimado (soma das cardinalidades estimadas do EXPLAIN):
+# acima de ADMISSION_QUEUE_COST a consulta espera na fila das pesadas, que roda
+# HEAVY_CONCURRENCY por vez; acima de ADMISSION_MAX_COST é recusada
+ADMISSION_QUEUE_COST = 50_000_000
+ADMISSION_MAX_COST = 5_000_000_000
+HEAVY_CONCURRENCY = 1
+# Consultas simultâneas por tenant e espera máxima (s) por uma vaga antes do 429
+TENANT_CONCURRENCY = 4
+ADMISSION_WAIT_S = 30
+DEFAULT_TENANT = "anonimo"
+# Tenants lembrados (o X-Tenant vem do cliente); acima disso os ociosos menos recentes saem
+MAX_TENANTS = 1024
+# Intervalo (s) entre verificações de desconexão do cliente
+DISCONNECT_POLL_S = 0.25
+# Motivos de interrupção de uma consulta
+CANCEL_TIMEOUT = "tempo limite"
+CANCEL_DISCONNECTED = "cliente desconectado"
+
+@lru_cache(maxsize=SQL_TEXT_CACHE_SIZE)
+def normalize_sql(sql):
+    """Forma canônica do SQL para a chave do cache: sem comentários, espaços
+    colapsados, palavras-chave em maiúsculas, nomes de função em minúsculas
+    (o DuckDB os põe em minúsculas também no nome da coluna) e sem ';' final.
+    Os demais identificadores mantêm a caixa: a de um alias é o nome da
+    coluna no resultado.
+    Memorizada: o sqlparse.format custa mais que muitas das consultas."""
+    formatted = sqlparse.format(sql, keyword_case="upper", strip_comments=True, strip_whitespace=True)
+    tokens = list(lexer.tokenize(formatted))
+    parts = [value.lower() if ttype in T.Name and i + 1 < len(tokens) and tokens[i + 1][1] == "(" else value
+             for i, (ttype, value) in enumerate(tokens)]
+    return "".join(parts).strip().rstrip(";").strip()
+
+@lru_cache(maxsize=SQL_TEXT_CACHE_SIZE)
+def parameterize(sql):
+    """(formato, literais) de um SELECT: o texto canônico (sem comentários,
+    espaços colapsados, palavras-chave em maiúsculas) com
+    os literais das cláusulas de PARAM_CLAUSES trocados por $1, $2... e o texto
+    original de cada literal, na ordem. (None, None) se não há o que parametrizar.
+    Os nomes ficam como vieram: a caixa de um alias é o nome da coluna no resultado.
+
+    Usa só o lexer do sqlparse (sem o agrupamento do parse, que custaria mais
+    que o planejamento poupado), e o resultado é memorizado por texto exato.
+    """
+    parts, literals = [], []
+    clauses = [None]  # cláusula corrente em cada nível de parênteses
+    previous = first = None
+    for ttype, value in lexer.tokenize(sql):
+        if ttype in T.Comment: continue
+        if ttype in T.Whitespace or ttype in T.Newline:
+            if parts and parts[-1] != " ": parts.append(" ")
+            continue
+        if first is None:
+            first = " ".join(value.upper().split())
+            if first not in ("SELECT", "WITH"): return None, None
+        if ttype in T.Punctuation and value == ";":
+            previous = ";"
+            continue
+        if previous == ";": return None, None  # mais de um comando
+
+        if ttype in T.Punctuation and value == "(":
+            clauses.append(clauses[-1])
+        elif ttype in T.Punctuation and value == ")" and len(clauses) > 1:
+            clauses.pop()
+        elif ttype in T.Keyword:
+            value = " ".join(value.upper().split())
+            if value in CLAUSE_KEYWORDS: clauses[-1] = value
+            elif value.endswith("JOIN"): clauses[-1] = "FROM"
+
+        if ttype in PARAM_TOKENS and clauses[-1] in PARAM_CLAUSES and previous not in TYPED_LITERAL_PREFIXES:
+            literals.append(value)
+            value = f"${len(literals)}"
+        parts.append(value)
+        previous = value.upper()
+
+    if not literals: return None, None
+    return "".join(parts).strip(), tuple(literals)
+
+class ResultCache:
+    """Cache LRU de DataFrames por SQL normalizado, válido para uma versão dos dados."""
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # chave -> (DataFrame, bytes)
+        self._bytes = 0
+        self._version = None
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def _sync_version(self, version):
+        if version != self._version:
+            if self._entries: self.invalidations += 1
+            self._entries.clear()
+            self._bytes = 0
+            self._version = version
+
+    def get(self, key, version):
+        with self._lock:
+            self._sync_version(version)
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    @staticmethod
+    def size_of(df: pd.DataFrame):
+        """Bytes do DataFrame. O deep=True percorre as strings das colunas de
+        texto: fora do event loop, quem chama roda isto numa thread."""
+        return int(df.memory_usage(index=True, deep=True).sum())
+
+    def put(self, key, version, df: pd.DataFrame, size=None):
+        """Guarda o resultado calculado na `version` lida antes da execução; se a
+        versão mudou durante a consulta, o resultado já nasceu velho e é descartado.
+        `size` (de size_of) é calculado aqui se não vier pronto."""
+        if size is None: size = self.size_of(df)
+        if size > self.max_bytes: return
+        with self._lock:
+            self._sync_version(version)
+            if version != self._version: return
+            old = self._entries.pop(key, None)
+            if old is not None: self._bytes -= old[1]
+            self._entries[key] = (df, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, freed) = self._entries.popitem(last=False)
+                self._bytes -= freed
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"versao_dados": self._version, "entradas": len(self._entries), "bytes": self._bytes,
+                    "acertos": self.hits, "falhas": self.misses,
+                    "taxa_acerto": round(self.hits / lookups, 4) if lookups else 0.0,
+                    "remocoes": self.evictions, "invalidacoes": self.invalidations}
+
+class InvalidQuery(ValueError):
+    """SQL recusado antes de qualquer execução (ex.: mais de um comando)."""
+
+class QueryCancelled(Exception):
+    """Consulta interrompida por tempo limite ou desconexão do cliente."""
+    def __init__(self, reason):
+        super().__init__(f"Consulta interrompida: {reason}")
+        self.reason = reason
+
+class QueryControl:
+    """Tempo limite e cancelamento de uma consulta.
+
+    O prazo começa a correr na espera por um cursor livre (start), não só
+    quando a consulta o recebe. O cursor só fica associado enquanto está
+    emprestado à consulta: um cancel() tardio não interrompe o que outro
+    pedido roda no mesmo cursor.
+    """
+    def __init__(self, timeout_s=QUERY_TIMEOUT_S):
+        self.timeout_s = timeout_s
+        self.reason = None
+        self._deadline = None
+        self._cur = None
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Marca o início do prazo (só na primeira chamada)."""
+        if self._deadline is None and self.timeout_s:
+            self._deadline = time.monotonic() + self.timeout_s
+
+    def remaining(self):
+        """Segundos até o tempo limite; None sem limite ou antes de start()."""
+        if self._deadline is None: return None
+        return max(0.0, self._deadline - time.monotonic())
+
+    def check(self):
+        """QueryCancelled se a consulta foi cancelada ou o prazo acabou."""
+        if self.remaining() == 0: self.cancel(CANCEL_TIMEOUT)
+        if self.reason: raise QueryCancelled(self.reason)
+
+    def bind(self, cur):
+        self.start()
+        self.check()
+        with self._lock:
+            if self.reason: raise QueryCancelled(self.reason)
+            self._cur = cur
+        if self.timeout_s:
+            self._timer = threading.Timer(self.remaining(), self.cancel, args=(CANCEL_TIMEOUT,))
+            self._timer.daemon = True
+            self._timer.start()
+
+    def unbind(self):
+        if self._timer is not None: self._timer.cancel()
+        with self._lock:
+            self._cur = None
+
+    def cancel(self, reason):
+        with self._lock:
+            if self.reason is None: self.reason = reason
+            if self._cur is not None: self._cur.interrupt()
+
+class PreparedCursor:
+    """Cursor do pool com os statements que ele já preparou (PREPARE vale por
+    conexão). Demais atributos são os do cursor DuckDB."""
+    def __init__(self, cur, size=STATEMENT_CACHE_SIZE, generation=0):
+        self.cur = cur
+        self.size = size
+        # Abertura da base a que o cursor pertence (ver QueryService.connect)
+        self.generation = generation
+        self._names = OrderedDict()  # formato -> nome do statement (None: o DuckDB não prepara)
+        self._seq = 0
+        self.counters = Counter()
+
+    def __getattr__(self, name):
+        return getattr(self.cur, name)
+
+    def _prepare(self, shape):
+        self._seq += 1
+        name = f"formato_{self._seq}"
+        try:
+            self.cur.execute(f"PREPARE {name} AS {shape}")
+        except duckdb.InterruptException:
+            raise
+        except duckdb.Error:
+            # Ex.: parâmetro cujo tipo o DuckDB não infere; o formato segue sem PREPARE
+            name = None
+        self._names[shape] = name
+        while len(self._names) > self.size:
+            _, old = self._names.popitem(last=False)
+            if old is not None: self.cur.execute(f"DEALLOCATE {old}")
+            self.counters["remocoes"] += 1
+        return name
+
+    def execute_prepared(self, sql):
+        """Executa o SQL pelo statement preparado do seu formato, se houver."""
+        shape, literals = parameterize(sql)
+        if shape is None:
+            return self.cur.execute(sql)
+        if shape in self._names:
+            self._names.move_to_end(shape)
+            name = self._names[shape]
+            self.counters["acertos" if name else "nao_preparaveis"] += 1
+        else:
+            name = self._prepare(shape)
+            self.counters["preparados" if name else "nao_preparaveis"] += 1
+        if name is None:
+            return self.cur.execute(sql)
+        try:
+            return self.cur.execute(f"EXECUTE {name}({', '.join(literals)})")
+        except duckdb.InterruptException:
+            raise
+        except duckdb.Error:
+            # Literal que o SQL original aceitaria mas o parâmetro tipado não: vale o original
+            self.counters["reexecutados"] += 1
+            return self.cur.execute(sql)
+
+class QueryService:
+    """Executa SQL somente leitura no DuckDB, passando pelo cache de resultados."""
+    def __init__(self, path=DUCKDB_PATH, cache=None, data_version=None, pool_size=CURSOR_POOL_SIZE):
+        self.path = path
+        self.cache = cache or ResultCache()
+        self.data_version = data_version or DataVersion()
+        self.pool_size = pool_size
+        self._conn = None
+        self._conn_version = None
+        self._generation = 0
+        self._cursors = queue.LifoQueue()
+        self._all_cursors = []
+        self._lent = Counter()       # geração -> cursores emprestados
+        self._retired = {}           # geração -> conexão substituída, à espera dos seus cursores
+        self._closed_counters = Counter()
+        self._lock = threading.Lock()
+
+    def connect(self):
+        """Abre a base e os cursores do pool; reabre quando a versão dos dados muda
+        (o espelho novo é outro arquivo no mesmo caminho, ver DuckDBMirror)."""
+        version = self.data_version.current()
+        with self._lock:
+            if self._conn is None or version != self._conn_version:
+                self._open(version)
+            return self._conn
+
+    def _open(self, version):
+        """Nova geração do pool. Se o espelho tem as views de consulta, cada
+        cursor as enxerga antes das tabelas do star schema."""
+        # Instância nova + ATTACH: duckdb.connect(path) devolveria a base que o
+        # processo já tem aberta (o arquivo anterior, ainda lido pelas consultas em andamento)
+        conn = duckdb.connect()
+        conn.execute(f"ATTACH '{self.path.replace(chr(39), chr(39) * 2)}' AS {MIRROR_CATALOG} (READ_ONLY)")
+        # As consultas não leem nem gravam arquivos e não mudam a configuração
+        conn.execute("SET enable_external_access = false")
+        conn.execute("SET lock_configuration = true")
+        has_views = conn.execute("SELECT COUNT(*) FROM information_schema.schemata WHERE catalog_name = ? "
+                                 "AND schema_name = ?", [MIRROR_CATALOG, QUERY_SCHEMA]).fetchone()[0]
+        cursors = [PreparedCursor(conn.cursor(), generation=self._generation + 1) for _ in range(self.pool_size)]
+        for cur in cursors:
+            # USE e search_path valem por cursor (cada um é uma conexão própria do DuckDB)
+            cur.execute(f"USE {MIRROR_CATALOG}")
+            if has_views: cur.execute(f"SET search_path = '{QUERY_SCHEMA},main'")
+        if self._conn is not None:
+            self._retire()
+        self._generation += 1
+        self._conn, self._conn_version, self._all_cursors = conn, version, cursors
+        for cur in cursors:
+            self._cursors.put(cur)
+
+    def _retire(self):
+        """Fecha os cursores livres da geração atual; a conexão fecha agora ou
+        quando o último cursor emprestado voltar (ver _release)."""
+        while True:
+            try:
+                self._close_cursor(self._cursors.get_nowait())
+            except queue.Empty:
+                break
+        if self._lent[self._generation]:
+            self._retired[self._generation] = self._conn
+        else:
+            self._lent.pop(self._generation, None)
+            self._conn.close()
+
+    def _close_cursor(self, cur):
+        self._closed_counters.update(cur.counters)
+        cur.close()
+
+    def _release(self, cur):
+        with self._lock:
+            self._lent[cur.generation] -= 1
+            if cur.generation == self._generation:
+                self._cursors.put(cur)
+                return
+            self._close_cursor(cur)
+            if not self._lent[cur.generation]:
+                del self._lent[cur.generation]
+                if cur.generation in self._retired:
+                    self._retired.pop(cur.generation).close()
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                while not self._cursors.empty():
+                    self._close_cursor(self._cursors.get_nowait())
+                self._conn.close()
+                self._conn = None
+                self._all_cursors = []
+            for conn in self._retired.values():
+                conn.close()
+            self._retired.clear()
+        self.cache.clear()
+
+    def statement_stats(self):
+        """Contadores dos statements preparados, somados entre os cursores
+        (inclusive os de aberturas anteriores da base)."""
+        with self._lock:
+            total = sum((cur.counters for cur in self._all_cursors), Counter()) + self._closed_counters
+        return dict(total)
+
+    def _acquire(self, control=None):
+        """Cursor livre da geração atual. Um cursor tirado da fila no instante em
+        que o pool foi reaberto é de uma conexão já fechada e é descartado.
+        Com `control`, a espera conta no prazo da consulta e é feita em fatias
+        de DISCONNECT_POLL_S: o prazo esgotado ou um cancel() durante a espera
+        terminam em QueryCancelled."""
+        if control is not None: control.start()
+        while True:
+            self.connect()
+            if control is None:
+                cur = self._cursors.get()
+            else:
+                control.check()
+                remaining = control.remaining()
+                wait_s = DISCONNECT_POLL_S if remaining is None else min(remaining, DISCONNECT_POLL_S)
+                try:
+                    cur = self._cursors.get(timeout=wait_s)
+                except queue.Empty:
+                    continue
+            with self._lock:
+                if cur.generation == self._generation:
+                    self._lent[cur.generation] += 1
+                    return cur
+                self._close_cursor(cur)
+
+    @contextmanager
+    def cursor(self, control=None):
+        """Empresta um cursor do pool; bloqueia enquanto todos estão em uso.
+        Com `control`, o tempo limite corre e cancel() interrompe a consulta
+        enquanto o cursor está emprestado; a espera por um cursor livre já
+        conta no tempo limite."""
+        cur = self._acquire(control)
+        try:
+            if control is None:
+                yield cur
+                return
+            control.bind(cur)
+            try:
+                yield cur
+            except duckdb.InterruptException:
+                if control.reason: raise QueryCancelled(control.reason)
+                raise
+            finally:
+                control.unbind()
+        finally:
+            self._release(cur)
+
+    def lookup(self, sql):
+        """(chave, versão dos dados, DataFrame do cache ou None). A chave e a
+        versão servem para guardar depois o resultado com cache.put."""
+        key = normalize_sql(sql)
+        version = self.data_version.current()
+        return key, version, self.cache.get(key, version)
+
+    def run(self, sql, control=None):
+        """Executa o SQL (sem cache) e devolve o DataFrame."""
+        with self.cursor(control) as cur:
+            return cur.execute_prepared(sql).df()
+
+    def estimate_cost(self, sql, control=None):
+        """Soma das cardinalidades estimadas dos operadores do plano. O
+        CROSS_PRODUCT, que não traz estimativa, conta o produto das entradas;
+        os demais operadores sem estimativa só repassam as linhas dos filhos.
+        O SQL precisa ser um único comando: com vários, o EXPLAIN executaria
+        todos menos o último (InvalidQuery; erro de sintaxe é duckdb.ParserException)."""
+        with self.cursor(control) as cur:
+            statements = cur.extract_statements(sql)
+            if len(statements) != 1:
+                raise InvalidQuery(f"Esperado exatamente um comando SQL, recebidos {len(statements)}")
+            plans = cur.execute(f"EXPLAIN (FORMAT json) {sql}").fetchall()
+
+        def walk(node):
+            # -> (linhas na saída do operador, custo acumulado da subárvore)
+            children = [walk(child) for child in node.get("children", [])]
+            est = str((node.get("extra_info") or {}).get("Estimated Cardinality", ""))
+            cost = sum(c for _, c in children)
+            if est.isdigit():
+                rows = float(est)
+            elif node.get("name") == "CROSS_PRODUCT":
+                rows = float(np.prod([r for r, _ in children])) if children else 0.0
+            else:
+                return max((r for r, _ in children), default=0.0), cost
+            return rows, rows + cost
+
+        return sum(walk(node)[1] for _, plan in plans for node in json.loads(plan))
+
+    def stream(self, sql, batch_rows=STREAM_BATCH_ROWS, control=None):
+        """Gerador que devolve o pyarrow.Schema do resultado e depois os
+        pyarrow.RecordBatch, lidos do cursor conforme o cliente consome.
+        O cursor fica emprestado até o gerador terminar ou ser fechado."""
+        with self.cursor(control) as cur:
+            reader = cur.execute_prepared(sql).fetch_record_batch(batch_rows)
+            yield reader.schema
+            yield from reader
+
+class AdmissionControl:
+    """Vagas por tenant e fila das consultas pesadas, ambas com espera limitada."""
+    def __init__(self, tenant_limit=TENANT_CONCURRENCY, heavy_limit=HEAVY_CONCURRENCY, wait_s=ADMISSION_WAIT_S,
+                 queue_cost=ADMISSION_QUEUE_COST, max_cost=ADMISSION_MAX_COST, max_tenants=MAX_TENANTS):
+        self.wait_s = wait_s
+        self.queue_cost = queue_cost
+        self.max_cost = max_cost
+        self.tenant_limit = tenant_limit
+        self.max_tenants = max_tenants
+        self._tenants = OrderedDict()  # nome -> [Semaphore, pedidos em andamento], em ordem de uso
+        self._heavy = asyncio.Semaphore(heavy_limit)
+        self.counters = Counter()
+
+    @asynccontextmanager
+    async def _acquire(self, sem, what):
+        try:
+            await asyncio.wait_for(sem.acquire(), timeout=self.wait_s)
+        except asyncio.TimeoutError:
+            self.counters["recusadas_espera"] += 1
+            raise HTTPException(status_code=429, detail=f"Sem vaga para {what} em {self.wait_s}s")
+        try:
+            yield
+        finally:
+            sem.release()
+
+    def _forget_idle_tenants(self):
+        """LRU: descarta os tenants sem pedidos em andamento que excedem max_tenants.
+        Um tenant descartado volta com o semáforo cheio, como um novo."""
+        excess = len(self._tenants) - self.max_tenants
+        if excess <= 0: return
+        idle = [name for name, (_, active) in self._tenants.items() if not active][:excess]
+        for name in idle:
+            del self._tenants[name]
+        self.counters["tenants_descartados"] += len(idle)
+
+    @asynccontextmanager
+    async def tenant(self, name):
+        """Vaga do tenant durante toda a consulta (inclusive EXPLAIN e streaming)."""
+        entry = self._tenants.get(name)
+        if entry is None:
+            entry = self._tenants[name] = [asyncio.Semaphore(self.tenant_limit), 0]
+            self._forget_idle_tenants()
+        self._tenants.move_to_end(name)
+        entry[1] += 1
+        try:
+            async with self._acquire(entry[0], f"o tenant {name}"):
+                yield
+        finally:
+            entry[1] -= 1
+
+    @asynccontextmanager
+    async def gate(self, cost):
+        """Decide pela estimativa: entra direto, espera na fila das pesadas ou é recusada."""
+        if cost > self.max_cost:
+            self.counters["recusadas_custo"] += 1
+            raise HTTPException(status_code=422, detail=f"Custo estimado {cost:.0f} acima do limite {self.max_cost}")
+        if cost <= self.queue_cost:
+            self.counters["admitidas"] += 1
+            yield
+            return
+        self.counters["pesadas"] += 1
+        async with self._acquire(self._heavy, "consultas pesadas"):
+            yield
+
+def _arrow_chunks(schema, batches):
+    """Arrow IPC (formato stream): esquema, um bloco por lote e o marcador de fim."""
+    buf = io.BytesIO()
+    with pa.ipc.new_stream(buf, schema) as writer:
+        for batch in batches:
+            writer.write_batch(batch)
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+def _ndjson_chunks(schema, batches):
+    """Uma linha JSON por registro; um bloco por lote."""
+    for batch in batches:
+        yield "".join(json.dumps(row, ensure_ascii=False, default=str) + "\n" for row in batch.to_pylist()).encode("utf-8")
+
+service = QueryService()
+admission = AdmissionControl()
+router = APIRouter(prefix="/consulta", tags=["consulta"])
+
+@contextmanager
+def _http_errors():
+    """Erros da consulta como respostas HTTP."""
+    try:
+        yield
+    except QueryCancelled as e:
+        admission.counters["interrompidas"] += 1
+        # 499: convenção (nginx) para pedido abandonado pelo cliente
+        raise HTTPException(status_code=504 if e.reason == CANCEL_TIMEOUT else 499, detail=str(e))
+    except (InvalidQuery, duckdb.Error) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+async def _admit(sql, stack: AsyncExitStack, tenant, request: Request):
+    """Vaga do tenant, estimativa de custo e portão de admissão, nesta ordem;
+    as vagas ficam presas a `stack`. A estimativa tem o prazo de uma consulta
+    (inclusive a espera pelo cursor) e é interrompida se o cliente desconectar."""
+    await stack.enter_async_context(admission.tenant(tenant))
+    control = QueryControl(QUERY_TIMEOUT_S)
+    with _http_errors():
+        cost = await _cancellable(request, control, service.estimate_cost, sql, control)
+    await stack.enter_async_context(admission.gate(cost))
+
+async def _cancellable(request: Request, control: QueryControl, fn, *args):
+    """Roda fn em uma thread e a interrompe se o cliente desconectar."""
+    task = asyncio.ensure_future(run_in_threadpool(fn, *args))
+    while not task.done():
+        await asyncio.wait({task}, timeout=DISCONNECT_POLL_S)
+        if not task.done() and await request.is_disconnected():
+            control.cancel(CANCEL_DISCONNECTED)
+    return task.result()
+
+class Consulta(BaseModel):
+    sql: str
+    cache: bool = True
+
+def _payload(df: pd.DataFrame, cached):
+    rows = df.astype(object).where(df.notna(), None).values.tolist()
+    return {"colunas": list(df.columns), "linhas": rows, "cache": cached}
+
+@router.post("")
+async def consultar(consulta: Consulta, request: Request, x_tenant: str = Header(DEFAULT_TENANT)):
+    # Normalização, consulta e conversão das linhas rodam fora do event loop
+    if consulta.cache:
+        key, version, df = await run_in_threadpool(service.lookup, consulta.sql)
+        if df is not None:
+            return await run_in_threadpool(_payload, df, True)
+
+    async with AsyncExitStack() as stack:
+        await _admit(consulta.sql, stack, x_tenant, request)
+        control = QueryControl(QUERY_TIMEOUT_S)
+        with _http_errors():
+            df = await _cancellable(request, control, service.run, consulta.sql, control)
+
+    if consulta.cache:
+        size = await run_in_threadpool(ResultCache.size_of, df)
+        service.cache.put(key, version, df, size)
+    return await run_in_threadpool(_payload, df, False)
+
+class ConsultaStream(BaseModel):
+    sql: str
+    formato: Literal["arrow", "ndjson"] = "ndjson"
+    lote: int = STREAM_BATCH_ROWS
+
+STREAM_MEDIA_TYPES = {"arrow": "application/vnd.apache.arrow.stream", "ndjson": "application/x-ndjson"}
+
+async def _stream_body(chunks, control: QueryControl, stack: AsyncExitStack):
+    """Envia os blocos; se o cliente some no meio, a consulta é interrompida e as vagas liberadas."""
+    try:
+        while (chunk := await run_in_threadpool(next, chunks, None)) is not None:
+            yield chunk
+    finally:
+        control.cancel(CANCEL_DISCONNECTED)
+        try:
+            chunks.close()
+        except ValueError:
+            pass  # ainda em execução em outra thread: termina pela interrupção
+        await stack.aclose()
+
+@router.post("/stream")
+async def consultar_stream(consulta: ConsultaStream, request: Request, x_tenant: str = Header(DEFAULT_TENANT)):
+    stack = AsyncExitStack()
+    control = QueryControl(STREAM_TIMEOUT_S)
+    try:
+        await _admit(consulta.sql, stack, x_tenant, request)
+        batches = service.stream(consulta.sql, max(1, consulta.lote), control)
+        # A consulta é executada antes da resposta: erros de SQL ainda viram 400
+        with _http_errors():
+            schema = await _cancellable(request, control, next, batches)
+    except BaseException:
+        await stack.aclose()
+        raise
+    encode = _arrow_chunks if consulta.formato == "arrow" else _ndjson_chunks
+    return StreamingResponse(_stream_body(encode(schema, batches), control, stack),
+                             media_type=STREAM_MEDIA_TYPES[consulta.formato])
+
+@router.get("/cache")
+async def cache_stats():
+    return {**service.cache.stats(), "statements": service.statement_stats()}
+
+@router.get("/admissao")
+async def admission_stats():
+    return dict(admission.counters)
@@ -0,0 +1,63 @@
+"""
+Testes do query_service sobre uma base DuckDB temporária.
+
+Uso:
+    python -m pytest -q test_query_service.py
+"""
+import time
+
+import duckdb
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import query_service as qs
+from datalake import DataVersion
+
+SQL_ALIASES = "SELECT uf AS Estado, COUNT(*) AS Total FROM t WHERE ano = 2023 GROUP BY uf ORDER BY uf"
+
+@pytest.fixture
+def service(tmp_path):
+    path = str(tmp_path / "espelho.duckdb")
+    with duckdb.connect(path) as conn:
+        conn.execute("CREATE TABLE t AS SELECT * FROM (VALUES ('SP', 2023), ('RJ', 2023), ('SP', 2022)) v(uf, ano)")
+    return qs.QueryService(path, data_version=DataVersion(str(tmp_path / "versao_dados.json")))
+
+def test_aliases_keep_their_case_through_prepared_statements(service):
+    shape, literals = qs.parameterize(SQL_ALIASES)
+    assert literals == ("2023",)
+    assert "AS Estado" in shape and "AS Total" in shape
+
+    with duckdb.connect(service.path, read_only=True) as conn:
+        expected = conn.execute(SQL_ALIASES).df()
+    # Duas vezes: a primeira prepara o statement, a segunda o reaproveita
+    for _ in range(2):
+        df = service.run(SQL_ALIASES)
+        assert list(df.columns) == ["Estado", "Total"] == list(expected.columns)
+        assert df.values.tolist() == expected.values.tolist()
+    assert service.statement_stats()["acertos"] >= 1
+
+def test_alias_case_is_part_of_the_cache_key():
+    lower = SQL_ALIASES.replace("Estado", "estado").replace("Total", "total")
+    assert qs.normalize_sql(SQL_ALIASES) != qs.normalize_sql(lower)
+    assert qs.normalize_sql(SQL_ALIASES) == qs.normalize_sql(SQL_ALIASES.lower().replace("estado", "Estado")
+                                                             .replace("total", "Total"))
+
+def test_estimate_cost_rejects_several_statements_without_running_them(service):
+    start = time.perf_counter()
+    with pytest.raises(qs.InvalidQuery):
+        service.estimate_cost("SELECT 1; SELECT count(*) FROM range(2000000000) a, range(10) b")
+    assert time.perf_counter() - start < 1
+    with pytest.raises(duckdb.ParserException):
+        service.estimate_cost("SELEC 1")
+    assert service.estimate_cost("SELECT * FROM t;") > 0
+
+def test_invalid_sql_is_a_client_error(service, monkeypatch):
+    monkeypatch.setattr(qs, "service", service)
+    app = FastAPI()
+    app.include_router(qs.router)
+    client = TestClient(app)
+    for sql in ("SELECT 1; SELECT 2", "SELEC 1", ""):
+        assert client.post("/consulta", json={"sql": sql, "cache": False}).status_code == 400
+        assert client.post("/consulta/stream", json={"sql": sql}).status_code == 400
+    assert client.post("/consulta", json={"sql": "SELECT count(*) n FROM t"}).json()["linhas"] == [[3]]